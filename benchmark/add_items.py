@@ -0,0 +1,57 @@
+"""Measure how the latency of adding an item changes as an order grows, and check that no addition is lost.
+
+The script creates one order and adds `--adds` items to it through /orders/addItemProcess from `--clients`
+concurrent clients. When every addition rewrites the whole order, the last additions are much slower than the first
+ones and concurrent additions conflict; a HINCRBY of the item's quantity in the `order_items:<order_id>` hash keeps
+every addition the same size. E.g.:
+    python benchmark/add_items.py --adds 1000 --clients 8
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+PRICE = 3
+
+thread_local = threading.local()
+
+
+def session() -> requests.Session:
+    if not hasattr(thread_local, 'session'):
+        thread_local.session = requests.Session()
+    return thread_local.session
+
+
+def add_item(url: str, order_id: str, i: int) -> tuple[int, float]:
+    start = time.perf_counter()
+    response = session().post(f"{url}/orders/addItemProcess/{order_id}/item-{i}/1/{PRICE}")
+    response.raise_for_status()
+    return i, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default="http://127.0.0.1:8000")
+    parser.add_argument('--adds', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--window', type=int, default=100, help="number of first/last additions to compare")
+    args = parser.parse_args()
+
+    user_id = requests.post(f"{args.url}/payment/create_user").json()['user_id']
+    order_id = requests.post(f"{args.url}/orders/create/{user_id}").json()['order_id']
+
+    with ThreadPoolExecutor(args.clients) as pool:
+        start = time.perf_counter()
+        results = sorted(pool.map(lambda i: add_item(args.url, order_id, i), range(args.adds)))
+        elapsed = time.perf_counter() - start
+
+    latencies = [latency for _, latency in results]
+    order = requests.get(f"{args.url}/orders/find/{order_id}").json()
+    print(f"additions:            {args.adds} in {elapsed:.2f}s ({args.adds / elapsed:.1f}/s)")
+    print(f"first {args.window} mean latency: {statistics.mean(latencies[:args.window]) * 1000:.2f}ms")
+    print(f"last {args.window} mean latency:  {statistics.mean(latencies[-args.window:]) * 1000:.2f}ms")
+    print(f"items in order:       {len(order['items'])} (expected {args.adds})")
+    print(f"total cost:           {order['total_cost']} (expected {args.adds * PRICE})")
@@ -0,0 +1,78 @@
+"""Measure how many checkouts per second the consumers process and how long a single checkout takes.
+
+The script loads orders, users and stock with the batch_init endpoints. Every client then repeatedly sends a checkout
+and polls its request status until it reached a final status. Run it once against the old and once against the new
+deployment, e.g.:
+    python benchmark/checkout_throughput.py --orders 2000 --replicas 4
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+FINAL_STATUSES = ('Processed', 'Failed')
+
+thread_local = threading.local()
+
+
+def session() -> requests.Session:
+    if not hasattr(thread_local, 'session'):
+        thread_local.session = requests.Session()
+    return thread_local.session
+
+
+def batch_init(url: str, n_orders: int, n_items: int, n_users: int):
+    requests.post(f"{url}/stock/batch_init/{n_items}/{10 * n_orders}/1").raise_for_status()
+    requests.post(f"{url}/payment/batch_init/{n_users}/{10 * n_orders}").raise_for_status()
+    requests.post(f"{url}/orders/batch_init/{n_orders}/{n_items}/{n_users}/1").raise_for_status()
+
+
+def checkout(url: str, order_id: int) -> tuple[str, float]:
+    sent = time.perf_counter()
+    response = session().post(f"{url}/orders/checkout/{order_id}")
+    response.raise_for_status()
+    return response.json()['correlation_id'], sent
+
+
+def wait_for(url: str, correlation_id: str, sent: float, poll_interval: float) -> tuple[str, float]:
+    while True:
+        status = session().get(f"{url}/orders/status/{correlation_id}").json()['status']
+        if status in FINAL_STATUSES:
+            return status, time.perf_counter() - sent
+        time.sleep(poll_interval)
+
+
+def percentile(values: list[float], p: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(p * len(values)))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default="http://127.0.0.1:8000")
+    parser.add_argument('--orders', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=1000, help="few items means high contention on stock")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=32, help="concurrent clients sending checkouts")
+    parser.add_argument('--replicas', type=int, default=1, help="number of consumer replicas that are running")
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    args = parser.parse_args()
+
+    batch_init(args.url, args.orders, args.items, args.users)
+
+    with ThreadPoolExecutor(args.clients) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(lambda i: wait_for(args.url, *checkout(args.url, i), args.poll_interval),
+                                 range(args.orders)))
+        elapsed = time.perf_counter() - start
+
+    latencies = [latency for _, latency in results]
+    processed = sum(status == 'Processed' for status, _ in results)
+    print(f"checkouts:            {args.orders} ({processed} processed, {args.orders - processed} failed)")
+    print(f"elapsed:              {elapsed:.2f}s")
+    print(f"checkouts/s:          {args.orders / elapsed:.1f}")
+    print(f"checkouts/s/replica:  {args.orders / elapsed / args.replicas:.1f}")
+    print(f"latency mean/p50/p99: {statistics.mean(latencies) * 1000:.1f}ms / "
+          f"{percentile(latencies, 0.5) * 1000:.1f}ms / {percentile(latencies, 0.99) * 1000:.1f}ms")
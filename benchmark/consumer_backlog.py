@@ -0,0 +1,57 @@
+"""Drain a large backlog of messages through the consumers and measure how long it takes.
+
+The script publishes `--messages` hello_world messages to the test queues of the consumers while they are stopped
+or busy, then waits until every message has been processed (each processed message sends a status message to a
+dedicated reply queue). Compare runs with different PREFETCH_COUNT/ACK_BATCH_SIZE settings, e.g.:
+    python benchmark/consumer_backlog.py --messages 100000 --replicas 4
+The peak RSS of every consumer is printed in its "Stats:" log lines (docker compose logs rabbitmq-consumer-0).
+"""
+import argparse
+import json
+import time
+import uuid
+
+import pika
+
+REPLY_QUEUE = "benchmark_status"
+
+
+def publish_backlog(channel, n_messages: int, n_replicas: int):
+    for i in range(n_messages):
+        channel.basic_publish(
+            exchange='',
+            routing_key=f"test_{i % n_replicas}",
+            body=json.dumps({"function": "hello_world", "args": ["Hello", i], "user_id": str(i)}).encode(),
+            properties=pika.BasicProperties(delivery_mode=2, correlation_id=str(uuid.uuid4()), reply_to=REPLY_QUEUE))
+
+
+def processed(channel) -> int:
+    return channel.queue_declare(queue=REPLY_QUEUE, durable=True, passive=True).method.message_count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--replicas', type=int, default=1)
+    args = parser.parse_args()
+
+    conn = pika.BlockingConnection(pika.ConnectionParameters(args.host))
+    channel = conn.channel()
+    channel.queue_declare(queue=REPLY_QUEUE, durable=True)
+    channel.queue_purge(queue=REPLY_QUEUE)
+    for replica in range(args.replicas):
+        channel.queue_declare(queue=f"test_{replica}", durable=True)
+
+    start = time.perf_counter()
+    publish_backlog(channel, args.messages, args.replicas)
+    print(f"Published {args.messages} messages in {time.perf_counter() - start:.2f}s")
+
+    while (done := processed(channel)) < args.messages:
+        print(f"{done}/{args.messages} processed")
+        time.sleep(1)
+    elapsed = time.perf_counter() - start
+    print(f"Drained {args.messages} messages in {elapsed:.2f}s ({args.messages / elapsed:.1f} messages/s)")
+
+    channel.queue_delete(queue=REPLY_QUEUE)
+    conn.close()
@@ -0,0 +1,97 @@
+"""wrk-style load test of /stock/find and /payment/pay with many concurrent keep-alive connections.
+
+Every connection sends its next request as soon as the previous response arrived, for `--duration` seconds. The
+load generator is a single asyncio process speaking HTTP/1.1, so it can hold 1000 connections. Compare the worker
+classes of the services, e.g.:
+    WORKER_CLASS=sync docker compose up -d
+    python benchmark/http_load.py --connections 1000 --duration 30
+    WORKER_CLASS=gevent docker compose up -d
+    python benchmark/http_load.py --connections 1000 --duration 30
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+
+def percentile(values: list[float], p: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(p * len(values)))]
+
+
+async def read_response(reader: asyncio.StreamReader) -> int:
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed")
+    status = int(status_line.split()[1])
+    length = 0
+    while (header := await reader.readline()) not in (b'\r\n', b''):
+        name, _, value = header.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def connection(host: str, port: int, method: str, paths: list[str], offset: int, deadline: float,
+                     latencies: list[float], errors: list[int]):
+    reader = writer = None
+    i = offset
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            request = (f"{method} {paths[i % len(paths)]} HTTP/1.1\r\nHost: {host}\r\n"
+                       f"Content-Length: 0\r\nConnection: keep-alive\r\n\r\n")
+            sent = time.perf_counter()
+            writer.write(request.encode())
+            status = await read_response(reader)
+            latencies.append(time.perf_counter() - sent)
+            if status != 200:
+                errors[0] += 1
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            errors[0] += 1
+            writer = None
+            await asyncio.sleep(0.1)
+        i += 1
+    if writer is not None:
+        writer.close()
+
+
+async def run(url: str, method: str, paths: list[str], connections: int, duration: float):
+    target = urlsplit(url)
+    paths = [f"{target.path.rstrip('/')}{path}" for path in paths]
+    latencies, errors = [], [0]
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(connection(target.hostname, target.port or 80, method, paths, i, deadline, latencies,
+                                      errors) for i in range(connections)))
+    return latencies, errors[0]
+
+
+def report(name: str, latencies: list[float], errors: int, duration: float):
+    print(f"{name}")
+    print(f"  requests/s:     {len(latencies) / duration:.1f} ({errors} errors)")
+    if latencies:
+        print(f"  latency mean/p50/p99: {statistics.mean(latencies) * 1000:.1f}ms / "
+              f"{percentile(latencies, 0.5) * 1000:.1f}ms / {percentile(latencies, 0.99) * 1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default="http://127.0.0.1:8000")
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--keys', type=int, default=100, help="number of items and users the requests spread over")
+    args = parser.parse_args()
+
+    items = [requests.post(f"{args.url}/stock/item/create/1").json()['item_id'] for _ in range(args.keys)]
+    users = [requests.post(f"{args.url}/payment/create_user").json()['user_id'] for _ in range(args.keys)]
+    for user_id in users:
+        requests.post(f"{args.url}/payment/add_funds/{user_id}/1000000000").raise_for_status()
+
+    report("GET /stock/find", *asyncio.run(run(args.url, "GET", [f"/stock/find/{i}" for i in items],
+                                               args.connections, args.duration)), args.duration)
+    report("POST /payment/pay", *asyncio.run(run(args.url, "POST", [f"/payment/pay/{u}/1" for u in users],
+                                                 args.connections, args.duration)), args.duration)
@@ -0,0 +1,50 @@
+"""Compare encode/decode time and frame size of the RabbitMQ messages in the old and the new wire format.
+
+Old: json.dumps/json.loads of plain dicts. New: the msgspec structs of common/messages.py as msgpack (and as JSON).
+    python benchmark/message_serialization.py
+"""
+import json
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common.messages import TaskMessage, StatusMessage, MSGPACK, JSON, encode, decode  # noqa: E402
+
+ORDER_ID = str(uuid.uuid4())
+USER_ID = str(uuid.uuid4())
+SNAPSHOT = {"version": 10,
+            "items": {str(uuid.uuid4()): 1 for _ in range(10)},
+            "user_id": USER_ID,
+            "total_cost": 100}
+
+MESSAGES = {
+    "checkout": (TaskMessage, {"function": "handle_checkout", "args": [ORDER_ID], "user_id": USER_ID}),
+    "checkout+snapshot": (TaskMessage,
+                          {"function": "handle_checkout", "args": [ORDER_ID, SNAPSHOT], "user_id": USER_ID}),
+    "status": (StatusMessage, {"correlation_id": str(uuid.uuid4()), "status": "Processed"}),
+}
+
+
+def measure(encode_message, decode_message, number: int) -> tuple[float, float, int]:
+    body = encode_message()
+    encode_time = timeit.timeit(encode_message, number=number) / number
+    decode_time = timeit.timeit(lambda: decode_message(body), number=number) / number
+    return encode_time * 1e6, decode_time * 1e6, len(body)
+
+
+if __name__ == '__main__':
+    number = 100_000
+    print(f"{'message':<18} {'format':<16} {'encode us':>10} {'decode us':>10} {'bytes':>6}")
+    for name, (message_type, fields) in MESSAGES.items():
+        message = message_type(**fields)
+        results = {
+            "json (old)": measure(lambda: json.dumps(fields).encode(), lambda b: json.loads(b.decode()), number),
+            "msgspec json": measure(lambda: encode(message, JSON), lambda b: decode(b, message_type, JSON), number),
+            "msgspec msgpack": measure(lambda: encode(message, MSGPACK), lambda b: decode(b, message_type, MSGPACK),
+                                       number),
+        }
+        for wire_format, (encode_us, decode_us, size) in results.items():
+            print(f"{name:<18} {wire_format:<16} {encode_us:>10.2f} {decode_us:>10.2f} {size:>6}")
@@ -0,0 +1,99 @@
+"""Measure the overhead of the metrics of common/metrics.py on a request like /stock/find.
+
+Two copies of the same Flask app are served in-process through the Flask test client, one plain and one with
+instrument_app and instrument_redis. Each request reads and decodes a StockValue from Redis. The apps take turns in
+many short rounds, so both see the same noise, and the fastest round of each is compared.
+The difference of two request times is noisy on a busy machine, so the script also times the instrumentation alone:
+the wrappers a request passes through (dispatch, pool checkout and one command) around functions that do nothing.
+Run it against a scratch Redis:
+    docker run --rm -p 6379:6379 redis:7.2-bookworm
+    python benchmark/metrics_overhead.py --redis redis://localhost:6379/0
+"""
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import redis
+from flask import Flask, Response, jsonify
+from msgspec import msgpack, Struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common.metrics import Registry, instrument_app, instrument_redis  # noqa: E402
+
+
+class StockValue(Struct):
+    stock: int
+    price: int
+
+
+def create_app(db: redis.Redis) -> Flask:
+    app = Flask("benchmark")
+
+    @app.get('/find/<item_id>')
+    def find_item(item_id: str):
+        entry: StockValue = msgpack.decode(db.get(item_id), type=StockValue)
+        return jsonify({"stock": entry.stock, "price": entry.price})
+
+    return app
+
+
+def seconds_per_request(client, n_requests: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n_requests):
+        client.get('/find/item')
+    return (time.perf_counter() - start) / n_requests
+
+
+def instrumentation_seconds(n: int) -> float:
+    """Time of the metric wrappers of one request, around functions that do nothing."""
+    response = Response()
+    app = Flask("benchmark")
+    app.add_url_rule('/find/<item_id>', 'find_item', lambda item_id: response)
+    app.full_dispatch_request = lambda: response
+    db = SimpleNamespace(execute_command=lambda *args, **options: None, pipeline=lambda *args, **kwargs: None,
+                         connection_pool=SimpleNamespace(get_connection=lambda *args, **kwargs: None))
+    registry = Registry()
+    instrument_app(app, registry)
+    instrument_redis(db, registry)
+    with app.test_request_context('/find/item'):
+        start = time.perf_counter()
+        for _ in range(n):
+            app.full_dispatch_request()
+            db.connection_pool.get_connection('GET')
+            db.execute_command('GET', 'item')
+        return (time.perf_counter() - start) / n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--redis', default="redis://localhost:6379/0")
+    parser.add_argument('--requests', type=int, default=100, help="requests per round")
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    plain_db = redis.Redis.from_url(args.redis)
+    plain_db.set('item', msgpack.encode(StockValue(stock=100, price=5)))
+    instrumented_db = redis.Redis.from_url(args.redis)
+    registry = Registry()
+    instrumented_app = create_app(instrumented_db)
+    instrument_app(instrumented_app, registry)
+    instrument_redis(instrumented_db, registry)
+    clients = {"plain": create_app(plain_db).test_client(), "instrumented": instrumented_app.test_client()}
+
+    for client in clients.values():
+        seconds_per_request(client, args.requests)
+    times = {name: [] for name in clients}
+    for _ in range(args.rounds):
+        for name, client in clients.items():
+            times[name].append(seconds_per_request(client, args.requests))
+
+    plain = min(times["plain"])
+    instrumented = min(times["instrumented"])
+    wrappers = min(instrumentation_seconds(100_000) for _ in range(5))
+    print(f"plain:           {plain * 1e6:.1f}us/request")
+    print(f"instrumented:    {instrumented * 1e6:.1f}us/request "
+          f"({(instrumented - plain) / plain * 100:+.2f}%, end to end)")
+    print(f"instrumentation: {wrappers * 1e6:.2f}us/request ({wrappers / plain * 100:.2f}% of a plain request)")
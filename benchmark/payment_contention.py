@@ -0,0 +1,57 @@
+"""Let many parallel payers pay from the same user and check that no payment was lost.
+
+Every payer repeatedly pays `--amount` from one user until the credit runs out. Afterwards the final credit has to be
+exactly the start credit minus the amount of all successful payments, e.g.:
+    python benchmark/payment_contention.py --payers 64 --credit 100000
+"""
+import argparse
+import threading
+import time
+
+import requests
+
+
+def run(url: str, user_id: str, payers: int, amount: int) -> tuple[int, int]:
+    successes = [0] * payers
+    rejections = [0] * payers
+
+    def payer(index: int):
+        session = requests.Session()
+        while True:
+            if session.post(f"{url}/payment/pay/{user_id}/{amount}").status_code == 200:
+                successes[index] += 1
+            else:
+                # the credit ran out
+                rejections[index] += 1
+                return
+
+    threads = [threading.Thread(target=payer, args=(i,)) for i in range(payers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(successes), sum(rejections)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default="http://127.0.0.1:8000")
+    parser.add_argument('--payers', type=int, default=64)
+    parser.add_argument('--credit', type=int, default=100_000)
+    parser.add_argument('--amount', type=int, default=1)
+    args = parser.parse_args()
+
+    user_id = requests.post(f"{args.url}/payment/create_user").json()['user_id']
+    requests.post(f"{args.url}/payment/add_funds/{user_id}/{args.credit}").raise_for_status()
+
+    start = time.perf_counter()
+    paid, rejected = run(args.url, user_id, args.payers, args.amount)
+    elapsed = time.perf_counter() - start
+
+    credit = requests.get(f"{args.url}/payment/find_user/{user_id}").json()['credit']
+    expected = args.credit - paid * args.amount
+    print(f"payments:    {paid} succeeded, {rejected} rejected")
+    print(f"payments/s:  {paid / elapsed:.1f}")
+    print(f"credit:      {credit} (expected {expected})")
+    if credit != expected:
+        raise SystemExit(f"Lost updates: {credit - expected} credit unaccounted for")
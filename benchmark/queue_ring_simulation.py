@@ -0,0 +1,72 @@
+"""Simulate how users spread over the main queues with `md5 % N` routing and with the consistent hash ring.
+
+For every number of queues the script reports how unevenly the users are spread (the largest queue relative to the
+mean, and the coefficient of variation) and which fraction of the users moves to another queue when a queue is
+added. Optionally the users are drawn from a Zipf distribution, so the load of a few heavy users is counted too.
+    python benchmark/queue_ring_simulation.py --users 100000 --replicas 2 4 8 16 --virtual-nodes 16 128
+"""
+import argparse
+import hashlib
+import os
+import random
+import statistics
+import sys
+import uuid
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common.hashring import HashRing, queue_names  # noqa: E402
+
+
+def modulo_router(replicas: int):
+    queues = queue_names(replicas)
+    return lambda key: queues[int(hashlib.md5(key.encode()).hexdigest(), 16) % replicas]
+
+
+def ring_router(replicas: int, virtual_nodes: int):
+    return HashRing(queue_names(replicas), virtual_nodes).node_for
+
+
+def spread(route, users: list[str], weights: list[int], replicas: int) -> tuple[float, float]:
+    load = Counter()
+    for user, weight in zip(users, weights):
+        load[route(user)] += weight
+    loads = [load[queue] for queue in queue_names(replicas)]
+    mean = statistics.mean(loads)
+    return max(loads) / mean, statistics.pstdev(loads) / mean
+
+
+def moved(route_before, route_after, users: list[str]) -> float:
+    return sum(route_before(user) != route_after(user) for user in users) / len(users)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--replicas', type=int, nargs='+', default=[2, 4, 8, 16])
+    parser.add_argument('--virtual-nodes', type=int, nargs='+', default=[16, 128])
+    parser.add_argument('--zipf', type=float, default=0.0,
+                        help="weigh user i with 1 / i^s messages instead of 1 message per user, e.g. 1.1")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    users = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(args.users)]
+    weights = [round(1_000_000 / (i + 1) ** args.zipf) for i in range(args.users)] if args.zipf \
+        else [1] * args.users
+
+    routers = {"md5 % N": modulo_router}
+    for virtual_nodes in args.virtual_nodes:
+        routers[f"ring ({virtual_nodes} vnodes)"] = \
+            lambda replicas, virtual_nodes=virtual_nodes: ring_router(replicas, virtual_nodes)
+
+    # Adding a queue to N queues gives the new queue a fair share of 1/(N+1) of the users at best
+    print(f"{'router':<20} {'queues':>6} {'max/mean':>9} {'cv':>6} {'moved on +1':>12} {'fair share':>10}")
+    for name, router in routers.items():
+        for replicas in args.replicas:
+            route = router(replicas)
+            max_over_mean, cv = spread(route, users, weights, replicas)
+            moved_fraction = moved(route, router(replicas + 1), users)
+            print(f"{name:<20} {replicas:>6} {max_over_mean:>9.3f} {cv:>6.3f} {moved_fraction:>12.1%} "
+                  f"{1 / (replicas + 1):>10.1%}")
@@ -0,0 +1,67 @@
+"""Compare the compensating checkout saga with the reservation saga when many buyers compete for a few items.
+
+Only a part of the checkouts can succeed because the stock runs out. The script reports checkouts/s and, when the
+stock and payment Redis instances are reachable, the number of write commands they executed (taken from INFO
+commandstats, which includes the commands run by Lua scripts). Run it once per SAGA_MODE of the consumers, e.g.:
+    SAGA_MODE=compensate docker compose up -d
+    python benchmark/reservation_contention.py --stock-redis redis://:redis@localhost:6380 \
+        --payment-redis redis://:redis@localhost:6381
+    SAGA_MODE=reserve docker compose up -d
+    python benchmark/reservation_contention.py ...
+The Redis ports are not published by docker-compose.yml, map them in an override file to count the writes.
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+import requests
+
+from checkout_throughput import checkout, wait_for
+
+WRITE_COMMANDS = ('set', 'mset', 'del', 'hset', 'hdel', 'zadd', 'zrem', 'incrby', 'hincrby', 'expire')
+
+
+def batch_init(url: str, n_orders: int, n_items: int, stock: int):
+    requests.post(f"{url}/stock/batch_init/{n_items}/{stock}/1").raise_for_status()
+    requests.post(f"{url}/payment/batch_init/{n_orders}/{100 * n_orders}").raise_for_status()
+    requests.post(f"{url}/orders/batch_init/{n_orders}/{n_items}/{n_orders}/1").raise_for_status()
+
+
+def writes(db: redis.Redis | None) -> int:
+    if db is None:
+        return 0
+    stats = db.info('commandstats')
+    return sum(stats.get(f"cmdstat_{command}", {}).get('calls', 0) for command in WRITE_COMMANDS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default="http://127.0.0.1:8000")
+    parser.add_argument('--orders', type=int, default=2000, help="number of buyers, every buyer checks out once")
+    parser.add_argument('--items', type=int, default=5)
+    parser.add_argument('--stock', type=int, default=100, help="starting stock of every item")
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--stock-redis', default=None, help="e.g. redis://:redis@localhost:6380")
+    parser.add_argument('--payment-redis', default=None, help="e.g. redis://:redis@localhost:6381")
+    args = parser.parse_args()
+
+    batch_init(args.url, args.orders, args.items, args.stock)
+    databases = [redis.Redis.from_url(url) if url else None for url in (args.stock_redis, args.payment_redis)]
+    writes_before = [writes(db) for db in databases]
+
+    with ThreadPoolExecutor(args.clients) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(lambda i: wait_for(args.url, *checkout(args.url, i), args.poll_interval),
+                                 range(args.orders)))
+        elapsed = time.perf_counter() - start
+
+    stock_writes, payment_writes = (writes(db) - before for db, before in zip(databases, writes_before))
+    processed = sum(status == 'Processed' for status, _ in results)
+    print(f"checkouts:       {args.orders} ({processed} processed, {args.orders - processed} failed)")
+    print(f"checkouts/s:     {args.orders / elapsed:.1f}")
+    if args.stock_redis:
+        print(f"stock writes:    {stock_writes} ({stock_writes / args.orders:.2f}/checkout)")
+    if args.payment_redis:
+        print(f"payment writes:  {payment_writes} ({payment_writes / args.orders:.2f}/checkout)")
@@ -0,0 +1,77 @@
+"""Measure checkout latency when a few users send most of the checkouts (Zipf distributed users).
+
+With `md5 % N` or ring routing all messages of a hot user land in one queue, so one replica saturates while the
+others idle. Run it once without and once with WORK_STEALING=true and compare the tail latency, e.g.:
+    python benchmark/skewed_checkout.py --checkouts 5000 --users 1000 --zipf 1.2 --replicas 4
+The orders are drawn with replacement, so an order can be checked out more than once; every checkout still pays
+and subtracts stock, which is all this benchmark is after.
+"""
+import argparse
+import random
+import statistics
+import time
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from checkout_throughput import checkout, wait_for, percentile
+
+
+def batch_init(url: str, n_orders: int, n_items: int, n_users: int, n_checkouts: int):
+    requests.post(f"{url}/stock/batch_init/{n_items}/{10 * n_checkouts}/1").raise_for_status()
+    requests.post(f"{url}/payment/batch_init/{n_users}/{10 * n_checkouts}").raise_for_status()
+    requests.post(f"{url}/orders/batch_init/{n_orders}/{n_items}/{n_users}/1").raise_for_status()
+
+
+def orders_per_user(url: str, n_orders: int, chunk_size: int = 1000) -> dict[str, list[str]]:
+    orders = defaultdict(list)
+    for start in range(0, n_orders, chunk_size):
+        order_ids = [str(i) for i in range(start, min(n_orders, start + chunk_size))]
+        for order in requests.post(f"{url}/orders/find_batch", json=order_ids).json():
+            if order:
+                orders[order['user_id']].append(order['order_id'])
+    return orders
+
+
+def zipf_orders(orders: dict[str, list[str]], n_checkouts: int, s: float, rng: random.Random) -> list[str]:
+    """Draw orders whose users follow a Zipf distribution: the user of rank r is drawn with weight 1 / r^s."""
+    users = sorted(orders)
+    rng.shuffle(users)
+    weights = [1 / (rank + 1) ** s for rank in range(len(users))]
+    return [rng.choice(orders[user]) for user in rng.choices(users, weights=weights, k=n_checkouts)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default="http://127.0.0.1:8000")
+    parser.add_argument('--checkouts', type=int, default=5000)
+    parser.add_argument('--orders', type=int, default=10_000)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--zipf', type=float, default=1.2, help="skew of the users, 0 means uniform")
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--replicas', type=int, default=1, help="number of consumer replicas that are running")
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    batch_init(args.url, args.orders, args.items, args.users, args.checkouts)
+    orders = orders_per_user(args.url, args.orders)
+    order_ids = zipf_orders(orders, args.checkouts, args.zipf, random.Random(args.seed))
+    user_of = {order_id: user_id for user_id, user_orders in orders.items() for order_id in user_orders}
+
+    with ThreadPoolExecutor(args.clients) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(lambda order_id: wait_for(args.url, *checkout(args.url, order_id), args.poll_interval),
+                                order_ids))
+        elapsed = time.perf_counter() - start
+
+    latencies = [latency for _, latency in results]
+    hottest_share = Counter(user_of[order_id] for order_id in order_ids).most_common(1)[0][1] / len(order_ids)
+    print(f"checkouts:                  {args.checkouts} (zipf {args.zipf}, hottest user {hottest_share:.1%})")
+    print(f"checkouts/s:                {args.checkouts / elapsed:.1f}")
+    print(f"checkouts/s/replica:        {args.checkouts / elapsed / args.replicas:.1f}")
+    print(f"latency mean/p50/p99/p99.9: {statistics.mean(latencies) * 1000:.1f}ms / "
+          f"{percentile(latencies, 0.5) * 1000:.1f}ms / {percentile(latencies, 0.99) * 1000:.1f}ms / "
+          f"{percentile(latencies, 0.999) * 1000:.1f}ms")
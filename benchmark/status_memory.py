@@ -0,0 +1,49 @@
+"""Compare the Redis memory used per request status record in the old and the new format.
+
+Old: a msgpack encoded RequestStatus struct under the bare correlation id, without TTL.
+New: a one-byte status code under "status:<correlation_id>", with a TTL.
+The old format with a TTL is measured as well, which is the like for like comparison of the value sizes.
+
+Run it against an empty scratch Redis, e.g.:
+    docker run --rm -p 6379:6379 redis:7.2-bookworm
+    python benchmark/status_memory.py --records 100000
+"""
+import argparse
+import uuid
+
+import redis
+from msgspec import msgpack, Struct
+
+
+class RequestStatus(Struct):
+    status: str
+
+
+def bytes_per_record(db: redis.Redis, records: dict[str, bytes], ttl: int | None) -> float:
+    db.flushdb()
+    before = db.info('memory')['used_memory']
+    pipe = db.pipeline(transaction=False)
+    for key, value in records.items():
+        pipe.set(key, value, ex=ttl)
+    pipe.execute()
+    return (db.info('memory')['used_memory'] - before) / len(records)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--records', type=int, default=100_000)
+    args = parser.parse_args()
+
+    db = redis.Redis(host=args.host, port=args.port, password=args.password)
+    ids = [str(uuid.uuid4()) for _ in range(args.records)]
+    old_records = {i: msgpack.encode(RequestStatus(status='Processed')) for i in ids}
+    old = bytes_per_record(db, old_records, None)
+    old_with_ttl = bytes_per_record(db, old_records, 24 * 60 * 60)
+    new = bytes_per_record(db, {f"status:{i}": b'S' for i in ids}, 24 * 60 * 60)
+    db.flushdb()
+    print(f"old format: {old:.1f} bytes/record")
+    print(f"old format: {old_with_ttl:.1f} bytes/record (including a TTL)")
+    print(f"new format: {new:.1f} bytes/record (including the TTL)")
@@ -0,0 +1,58 @@
+"""Measure stock subtractions per second at several levels of concurrency.
+
+Run it once against the old and once against the new stock service, e.g.:
+    python benchmark/stock_subtract.py --url http://127.0.0.1:8000 --duration 10
+"""
+import argparse
+import threading
+import time
+
+import requests
+
+
+def create_items(url: str, n_items: int, stock: int) -> list[str]:
+    item_ids = []
+    for _ in range(n_items):
+        item_id = requests.post(f"{url}/stock/item/create/1").json()['item_id']
+        requests.post(f"{url}/stock/add/{item_id}/{stock}")
+        item_ids.append(item_id)
+    return item_ids
+
+
+def run(url: str, item_ids: list[str], clients: int, duration: float) -> tuple[int, int]:
+    counts = [0] * clients
+    errors = [0] * clients
+    deadline = time.perf_counter() + duration
+
+    def client(index: int):
+        session = requests.Session()
+        i = index
+        while time.perf_counter() < deadline:
+            item_id = item_ids[i % len(item_ids)]
+            if session.post(f"{url}/stock/subtract/{item_id}/1").status_code == 200:
+                counts[index] += 1
+            else:
+                errors[index] += 1
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts), sum(errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default="http://127.0.0.1:8000")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 64])
+    parser.add_argument('--items', type=int, default=64, help="1 measures a single hot item")
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args()
+
+    items = create_items(args.url, args.items, 10_000_000)
+    print(f"{'clients':>8} {'subtract/s':>12} {'errors':>8}")
+    for n_clients in args.clients:
+        ok, failed = run(args.url, items, n_clients, args.duration)
+        print(f"{n_clients:>8} {ok / args.duration:>12.1f} {failed:>8}")
@@ -0,0 +1,39 @@
+import bisect
+import hashlib
+
+# Every queue is placed on the ring this many times, which evens out the share of the users each queue gets
+VIRTUAL_NODES = 128
+# Barrier messages of a ring handoff carry a correlation id with this prefix
+BARRIER_PREFIX = "barrier:"
+HANDOFF_BARRIER = "handoff_barrier"
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping keys (user ids) to nodes (queue names).
+
+    Adding or removing a node only moves the keys of the ring segments it gains or loses, about 1/N of all keys,
+    instead of remapping almost every key like `hash(key) % N` does.
+    """
+
+    def __init__(self, nodes: list[str], virtual_nodes: int = VIRTUAL_NODES):
+        self.nodes = list(nodes)
+        points = sorted((hash_key(f"{node}#{i}"), node) for node in self.nodes for i in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def node_for(self, key: str) -> str:
+        """The node of the first point on the ring at or after the hash of the key."""
+        return self.owners[bisect.bisect_left(self.hashes, hash_key(key)) % len(self.hashes)]
+
+
+def queue_names(replicas: int, prefix: str = "main_") -> list[str]:
+    return [f"{prefix}{i}" for i in range(replicas)]
+
+
+def barrier_id(epoch: int, queue: str) -> str:
+    """Correlation id of the barrier message that closes `queue` for the users moved away in ring `epoch`."""
+    return f"{BARRIER_PREFIX}{epoch}:{queue}"
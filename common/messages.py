@@ -0,0 +1,43 @@
+from typing import Any, Literal
+
+from msgspec import msgpack, json, Struct, DecodeError
+
+# Content types of the RabbitMQ messages, sent along in the content_type property so the receiver can decode them.
+# Messages without a content type are JSON, as they were before the formats could be negotiated.
+MSGPACK = "application/msgpack"
+JSON = "application/json"
+
+
+class TaskMessage(Struct, omit_defaults=True):
+    """Asks a consumer to call `function(*args)`. Messages of the same user_id are processed in order.
+
+    With work stealing the messages of a user are numbered by `seq`, so consumers competing for a queue can keep
+    them in order. While a ring change is handed off, the messages of a user that moved to another queue carry the
+    correlation id of the barrier of its previous queue in `after`, and are only processed once that barrier was.
+    """
+    function: str
+    args: list[Any]
+    user_id: str | None = None
+    seq: int | None = None
+    after: str | None = None
+
+
+class StatusMessage(Struct):
+    """Reports the status of the request with the given correlation id back to the order service. Decoding rejects
+    any other status, so an unknown status can not reach the status consumer."""
+    correlation_id: str
+    status: Literal['Pending', 'Processed', 'Failed', 'Retrying']
+
+
+def encode(message: Struct, content_type: str) -> bytes:
+    if content_type == MSGPACK:
+        return msgpack.encode(message)
+    return json.encode(message)
+
+
+def decode(body: bytes, message_type: type[Struct], content_type: str | None) -> Struct:
+    """Decode and validate a message, raises DecodeError if the body does not match the message type."""
+    if content_type == MSGPACK:
+        return msgpack.decode(body, type=message_type)
+    return json.decode(body, type=message_type)
+
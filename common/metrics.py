@@ -0,0 +1,379 @@
+"""Counters and latency histograms in the Prometheus text format, without dependencies outside the standard library.
+
+Metrics register themselves in REGISTRY when they are created at import time:
+    REQUESTS = Counter("requests_total", "Requests handled", ("route",))
+    REQUESTS.labels("/find").inc()
+    with LATENCY.labels("/find").time():
+        ...
+    QUEUE_LAG.set_function(lambda: consumer.lag)
+An update costs a few additions, so metrics can stay on in production (see benchmark/metrics_overhead.py).
+Gunicorn workers are separate processes with a registry each. With `directory` set, every worker writes a snapshot of
+its registry to a file there every few seconds, and /metrics answers with the sum of all of them.
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds in seconds, from a fast Redis command to a saga step that had to retry
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SNAPSHOT_INTERVAL = 5
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, "Metric"] = {}
+
+    def register(self, metric: "Metric"):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children: dict[tuple[str, ...], object] = {}
+        registry.register(self)
+
+    def labels(self, *values):
+        """The child for these label values, created on first use and cached."""
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def snapshot(self) -> dict:
+        return {"type": self.kind, "help": self.documentation, "labels": self.labelnames,
+                "samples": [[[str(value) for value in values], child.value()]
+                            for values, child in list(self.children.items())]}
+
+
+class CounterChild:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0.0
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.count += amount
+
+    def value(self) -> float:
+        return self.count
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class GaugeChild:
+    def __init__(self):
+        self.current = 0.0
+        self.function = None
+
+    def set(self, value: float):
+        self.current = value
+
+    def set_function(self, function):
+        """Read the value from `function` whenever the metrics are collected, instead of setting it."""
+        self.function = function
+
+    def value(self) -> float:
+        return self.function() if self.function is not None else self.current
+
+
+class Gauge(Metric):
+    """A value that goes up and down. The values of several processes are added up, or with
+    `multiprocess_mode="max"` only the largest is reported, for values that every process measures the same way."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), registry: Registry = REGISTRY,
+                 multiprocess_mode: str = "sum"):
+        self.multiprocess_mode = multiprocess_mode
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self) -> GaugeChild:
+        return GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def snapshot(self) -> dict:
+        return {**super().snapshot(), "multiprocess_mode": self.multiprocess_mode}
+
+
+class Timer:
+    def __init__(self, child: "HistogramChild"):
+        self.child = child
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(perf_counter() - self.start)
+
+
+class HistogramChild:
+    """Observations are recorded without a lock, which would triple their cost. A thread switch in the middle of an
+    update can lose an observation, which only happens rarely and is accepted for latency histograms."""
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # Observations per bucket, not cumulative; the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, amount: float):
+        self.counts[bisect_left(self.buckets, amount)] += 1
+        self.sum += amount
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+    def value(self) -> list:
+        return [*self.counts, self.sum]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), registry: Registry = REGISTRY,
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+    def observe(self, amount: float):
+        self.labels().observe(amount)
+
+    def time(self) -> Timer:
+        return self.labels().time()
+
+    def snapshot(self) -> dict:
+        return {**super().snapshot(), "buckets": self.buckets}
+
+
+def merge(snapshots: list[dict]) -> dict:
+    """Add up the samples of the same metric and labels of several snapshots, or take the largest for gauges with
+    multiprocess_mode "max"."""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            for values, value in metric["samples"]:
+                key = tuple(values)
+                current = target["samples"].get(key)
+                if current is None:
+                    target["samples"][key] = value
+                elif isinstance(value, list):
+                    target["samples"][key] = [a + b for a, b in zip(current, value)]
+                elif metric.get("multiprocess_mode") == "max":
+                    target["samples"][key] = max(current, value)
+                else:
+                    target["samples"][key] = current + value
+    return merged
+
+
+def format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_snapshot(merged: dict) -> str:
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for values, value in sorted(metric["samples"].items()):
+            if metric["type"] == "histogram":
+                cumulative = 0
+                for bound, count in zip([*metric["buckets"], "+Inf"], value[:-1]):
+                    cumulative += count
+                    le = 'le="{}"'.format(bound if bound == "+Inf" else format_value(bound))
+                    lines.append(f"{name}_bucket{format_labels(metric['labels'], values, le)} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(metric['labels'], values)} {format_value(value[-1])}")
+                lines.append(f"{name}_count{format_labels(metric['labels'], values)} {cumulative}")
+            else:
+                lines.append(f"{name}{format_labels(metric['labels'], values)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot_path(directory: str, pid: int) -> str:
+    return os.path.join(directory, f"{pid}.json")
+
+
+def write_snapshot(registry: Registry, directory: str):
+    path = snapshot_path(directory, os.getpid())
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(registry.snapshot(), file)
+    os.replace(f"{path}.tmp", path)
+
+
+def start_snapshots(registry: Registry, directory: str, interval: float = SNAPSHOT_INTERVAL):
+    """Write the snapshot of this process to `directory` every `interval` seconds, from a daemon thread."""
+    os.makedirs(directory, exist_ok=True)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                write_snapshot(registry, directory)
+            except OSError as e:
+                print(f"Could not write the metrics snapshot: {e}")
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def render(registry: Registry = REGISTRY, directory: str | None = None) -> str:
+    """The metrics of this process, plus the last snapshots of the other processes in `directory` if given."""
+    snapshots = [registry.snapshot()]
+    if directory and os.path.isdir(directory):
+        own = snapshot_path(directory, os.getpid())
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".json") and entry.path != own:
+                try:
+                    with open(entry.path) as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    continue
+    return render_snapshot(merge(snapshots))
+
+
+def serve(port: int, registry: Registry = REGISTRY):
+    """Answer GET /metrics on `port` from a daemon thread, for processes without a web server of their own."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render(registry).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def instrument_app(app, registry: Registry = REGISTRY, directory: str | None = None):
+    """Record the latency of every request of a Flask app per route and status, and add GET /metrics to it."""
+    from flask import request
+
+    duration = Histogram("http_request_duration_seconds", "Latency of the HTTP requests, per route",
+                         ("method", "route", "status"), registry)
+    full_dispatch_request = app.full_dispatch_request
+
+    # Wraps the dispatch instead of adding before/after request hooks, which cost more than the measurement itself
+    def timed_full_dispatch_request():
+        start = perf_counter()
+        status = 500
+        try:
+            response = full_dispatch_request()
+            status = response.status_code
+            return response
+        finally:
+            current = request._get_current_object()
+            route = current.url_rule.rule if current.url_rule else "unmatched"
+            duration.labels(current.method, route, status).observe(perf_counter() - start)
+
+    app.full_dispatch_request = timed_full_dispatch_request
+
+    @app.get("/metrics")
+    def metrics():
+        return render(registry, directory), 200, {"Content-Type": CONTENT_TYPE}
+
+    if directory:
+        start_snapshots(registry, directory)
+
+
+def instrument_redis(db, registry: Registry = REGISTRY):
+    """Record the latency of every command and pipeline of a redis-py client, and the time spent waiting for a free
+    connection of its pool."""
+    commands = Histogram("redis_command_duration_seconds", "Latency of the Redis commands and pipelines",
+                         ("command",), registry)
+    pool_wait = Histogram("redis_pool_wait_seconds", "Time spent waiting for a connection of the Redis pool",
+                          (), registry).labels()
+
+    execute_command = db.execute_command
+    create_pipeline = db.pipeline
+    get_connection = db.connection_pool.get_connection
+
+    def timed_execute_command(*args, **options):
+        start = perf_counter()
+        try:
+            return execute_command(*args, **options)
+        finally:
+            commands.labels(args[0]).observe(perf_counter() - start)
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = create_pipeline(*args, **kwargs)
+        execute = pipe.execute
+        label = "MULTI" if pipe.transaction else "PIPELINE"
+
+        def timed_execute(*execute_args, **execute_kwargs):
+            start = perf_counter()
+            try:
+                return execute(*execute_args, **execute_kwargs)
+            finally:
+                commands.labels(label).observe(perf_counter() - start)
+
+        pipe.execute = timed_execute
+        return pipe
+
+    def timed_get_connection(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return get_connection(*args, **kwargs)
+        finally:
+            pool_wait.observe(perf_counter() - start)
+
+    db.execute_command = timed_execute_command
+    db.pipeline = timed_pipeline
+    db.connection_pool.get_connection = timed_get_connection
@@ -0,0 +1,149 @@
+"""Reservations of stock and credit that are held for a checkout until they are committed, released or expire.
+
+A reservation is a hash `reservation:<id>` of the held key -> amount, and its id is in the RESERVATIONS_KEY sorted
+set, scored by the time it expires, until it is committed or released. The scripts here only depend on the field of
+the held values (`stock` or `credit`), the reserve scripts themselves live with the services.
+"""
+import os
+import time
+from logging import Logger
+
+from redis.commands.core import Script
+from redis.exceptions import RedisError
+
+# Reserved stock and credit are held for RESERVATION_TTL seconds, after that the reaper gives them back
+RESERVATION_TTL = float(os.environ.get('RESERVATION_TTL', 30))
+RESERVATION_REAP_INTERVAL = float(os.environ.get('RESERVATION_REAP_INTERVAL', 1))
+RESERVATION_REAP_BATCH_SIZE = int(os.environ.get('RESERVATION_REAP_BATCH_SIZE', 100))
+RESERVATION_PREFIX = "reservation:"
+# Sorted set of the ids of all open reservations, scored by the time they expire
+RESERVATIONS_KEY = "reservations"
+
+RESERVATION_NOT_FOUND = 1
+RESERVATION_HELD = 3
+RESERVATION_COMMITTED = 4
+RESERVATION_CONFLICT = 5
+
+# Part of the reserve scripts, after they put the requested key, amount pairs in `held`. A reservation that exists
+# already is only a retry if it holds the same amounts: it returns {RESERVATION_HELD, 0} or {RESERVATION_COMMITTED, 0}
+# then, and {RESERVATION_CONFLICT, 0} otherwise.
+EXISTING_RESERVATION_LUA = """
+local function same_quantities(stored, requested)
+    if #stored ~= #requested then
+        return false
+    end
+    local quantities = {}
+    for i = 1, #stored, 2 do
+        quantities[stored[i]] = tonumber(stored[i + 1])
+    end
+    for i = 1, #requested, 2 do
+        if quantities[requested[i]] ~= tonumber(requested[i + 1]) then
+            return false
+        end
+    end
+    return true
+end
+local reservation_type = redis.call('TYPE', KEYS[1]).ok
+if reservation_type ~= 'none' then
+    local stored
+    if reservation_type == 'hash' then
+        stored = redis.call('HGETALL', KEYS[1])
+    else
+        stored = cmsgpack.unpack(redis.call('GET', KEYS[1]))
+    end
+    if not same_quantities(stored, held) then
+        return {5, 0}
+    end
+    if reservation_type == 'hash' then
+        return {3, 0}
+    end
+    return {4, 0}
+end
+"""
+
+# Gives the held amounts of a reservation back to HELD_FIELD of the msgpack encoded values they were taken from. The
+# keys of the values are read from the reservation hash.
+RELEASE_RESERVATION_LUA_FUNCTION = """
+local function release(key)
+    if redis.call('TYPE', key).ok ~= 'hash' then
+        return false
+    end
+    local held = redis.call('HGETALL', key)
+    for i = 1, #held, 2 do
+        local entry = redis.call('GET', held[i])
+        if entry then
+            local value = cmsgpack.unpack(entry)
+            value[HELD_FIELD] = value[HELD_FIELD] + tonumber(held[i + 1])
+            redis.call('SET', held[i], cmsgpack.pack(value))
+        end
+    end
+    redis.call('DEL', key)
+    return #held > 0
+end
+"""
+
+# Keeps the subtracted amounts by replacing the reservation with a committed marker that expires after ARGV[2]
+# seconds, so committing again succeeds and the reservation can not be released anymore. The marker is a string
+# holding the reserved amounts, which a retried reserve is compared with.
+# KEYS = reservation hash, expiry set. ARGV = reservation id, marker TTL.
+# Returns 0 if committed, 1 if there was no reservation.
+COMMIT_RESERVATION_LUA = """
+local reservation_type = redis.call('TYPE', KEYS[1]).ok
+if reservation_type == 'string' then
+    return 0
+end
+if reservation_type ~= 'hash' then
+    return 1
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('SET', KEYS[1], cmsgpack.pack(redis.call('HGETALL', KEYS[1])), 'EX', ARGV[2])
+return 0
+"""
+
+
+def release_function_lua(field: str) -> str:
+    return f"local HELD_FIELD = '{field}'" + RELEASE_RESERVATION_LUA_FUNCTION
+
+
+def release_reservation_lua(field: str) -> str:
+    """KEYS = reservation hash, expiry set. ARGV = reservation id.
+    Returns 0 if released, 1 if there was no reservation."""
+    return release_function_lua(field) + """
+redis.call('ZREM', KEYS[2], ARGV[1])
+if release(KEYS[1]) then
+    return 0
+end
+return 1
+"""
+
+
+def release_expired_reservations_lua(field: str) -> str:
+    """KEYS = expiry set. ARGV = now, max number of reservations to release, reservation key prefix.
+    Returns the number of released reservations."""
+    return release_function_lua(field) + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, reservation_id in ipairs(expired) do
+    release(ARGV[3] .. reservation_id)
+    redis.call('ZREM', KEYS[1], reservation_id)
+end
+return #expired
+"""
+
+
+def reservation_key(reservation_id: str) -> str:
+    return f"{RESERVATION_PREFIX}{reservation_id}"
+
+
+def release_expired_reservations(release_expired_script: Script, logger: Logger):
+    """Give the amounts of expired reservations back, forever. Runs in every worker, the Lua script keeps that safe."""
+    while True:
+        try:
+            released = release_expired_script(keys=[RESERVATIONS_KEY],
+                                              args=[time.time(), RESERVATION_REAP_BATCH_SIZE, RESERVATION_PREFIX])
+        except RedisError:
+            logger.exception("Failed to release expired reservations")
+            released = 0
+        if released:
+            logger.info(f"Released {released} expired reservations")
+        if released < RESERVATION_REAP_BATCH_SIZE:
+            time.sleep(RESERVATION_REAP_INTERVAL)
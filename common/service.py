@@ -0,0 +1,127 @@
+"""Helpers of the Flask services: their Redis connection, idempotency records and batch endpoints."""
+import os
+from itertools import islice
+from logging import Logger
+from typing import Callable
+
+import redis
+from flask import Response, abort, jsonify, request
+from msgspec import msgpack
+
+# Every worker shares one pool of at most REDIS_POOL_SIZE connections between its threads or greenlets. When all of
+# them are in use, a request waits up to REDIS_POOL_TIMEOUT seconds for one instead of opening another connection.
+REDIS_POOL_SIZE = int(os.environ.get('REDIS_POOL_SIZE', 50))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+
+BATCH_INIT_CHUNK_SIZE = int(os.environ.get('BATCH_INIT_CHUNK_SIZE', 10_000))
+BATCH_INIT_PROGRESS_KEY = "batch_init:progress"
+
+# Requests with an Idempotency-Key header are applied once, a repeated request gets the reply of the first one
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_PREFIX = "idempotency:"
+# Long enough for the redeliveries and retries of a saga step; a record per request and step kept for a day filled
+# the 512MB databases under sustained load
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 5 * 60))
+IDEMPOTENCY_KEY_REUSED = -1
+IDEMPOTENCY_KEY_REUSED_STR = "The Idempotency-Key was already used for a request with other arguments"
+
+# Runs the update() function of a script at most once per idempotency key. KEYS[1] is the idempotency record ('' for
+# requests without a key), ARGV[1] its TTL. The reply of update() is stored in the record in the same script, so a
+# repeated request gets the stored reply without writing again. The record also holds a hash of the other keys and
+# arguments, a key reused for a request with other ones is refused with {IDEMPOTENCY_KEY_REUSED, 0}.
+IDEMPOTENT_LUA = """
+local fingerprint
+if KEYS[1] ~= '' then
+    fingerprint = redis.sha1hex(table.concat(KEYS, '\\n') .. '\\n' .. table.concat(ARGV, '\\n', 2))
+    local recorded = redis.call('GET', KEYS[1])
+    if recorded then
+        recorded = cmsgpack.unpack(recorded)
+        if recorded[1] ~= fingerprint then
+            return {-1, 0}
+        end
+        return recorded[2]
+    end
+end
+local result = update()
+if KEYS[1] ~= '' then
+    redis.call('SET', KEYS[1], cmsgpack.pack({fingerprint, result}), 'EX', ARGV[1])
+end
+return result
+"""
+
+
+def connect_redis() -> redis.Redis:
+    return redis.Redis(connection_pool=redis.BlockingConnectionPool(
+        host=os.environ['REDIS_HOST'],
+        port=int(os.environ['REDIS_PORT']),
+        password=os.environ['REDIS_PASSWORD'],
+        db=int(os.environ['REDIS_DB']),
+        max_connections=REDIS_POOL_SIZE,
+        timeout=REDIS_POOL_TIMEOUT))
+
+
+def check_redis_maxclients(db: redis.Redis, logger: Logger):
+    """Log an error if the pools of all workers together may open more connections than Redis accepts.
+
+    WEB_CONCURRENCY is the number of gunicorn workers per container, SERVICE_REPLICAS the number of containers.
+    """
+    workers = int(os.environ.get('WEB_CONCURRENCY', 1)) * int(os.environ.get('SERVICE_REPLICAS', 1))
+    try:
+        maxclients = int(db.config_get('maxclients')['maxclients'])
+    except (redis.exceptions.RedisError, KeyError):
+        logger.warning("Could not read maxclients from Redis, skipping the connection pool check")
+        return
+    if workers * REDIS_POOL_SIZE > maxclients:
+        logger.error(f"{workers} workers with a pool of {REDIS_POOL_SIZE} connections each may open "
+                     f"{workers * REDIS_POOL_SIZE} connections, but Redis accepts only {maxclients} clients")
+
+
+def idempotency_record_key() -> str:
+    """The key recording the reply to the Idempotency-Key of the request, '' if the request has none. Keys are scoped
+    to the endpoint, the same key sent to another endpoint is another request."""
+    idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+    return f"{IDEMPOTENCY_PREFIX}{request.endpoint}:{idempotency_key}" if idempotency_key else ''
+
+
+def get_ids_from_request() -> list[str]:
+    """Read a list of ids, encoded as msgpack or JSON depending on the Content-Type."""
+    try:
+        if request.mimetype == 'application/msgpack':
+            return msgpack.decode(request.get_data(), type=list[str])
+        return [str(key) for key in request.get_json(force=True)]
+    except Exception:
+        abort(400, "Invalid batch, expected a list of ids")
+
+
+def batch_response(entries: list) -> Response:
+    """Answer with msgpack if the client prefers it, else with JSON."""
+    if request.accept_mimetypes.best == 'application/msgpack':
+        return Response(msgpack.encode(entries), mimetype='application/msgpack')
+    return jsonify(entries)
+
+
+def batch_init_chunked(db: redis.Redis, generate_value: Callable[[int], object], n: int, params: str, resume: bool,
+                       logger: Logger, write_chunk: Callable[[redis.client.Pipeline, dict], None] | None = None) -> int:
+    """Write keys 0..n-1 to Redis in pipelined chunks of BATCH_INIT_CHUNK_SIZE, generating the values lazily.
+
+    `write_chunk` queues the writes of a {key: value} chunk on the pipeline, by default an MSET of the values.
+    The number of written entries is stored together with each chunk, so an unfinished load with the same params
+    (e.g. cut short by a worker timeout) continues where it stopped instead of starting over.
+    """
+    start = 0
+    progress = db.hgetall(BATCH_INIT_PROGRESS_KEY)
+    if resume and progress.get(b'params') == params.encode() and int(progress[b'written']) < n:
+        start = int(progress[b'written'])
+    entries = ((f"{i}", generate_value(i)) for i in range(start, n))
+    written = start
+    while chunk := dict(islice(entries, BATCH_INIT_CHUNK_SIZE)):
+        written += len(chunk)
+        pipe = db.pipeline(transaction=False)
+        if write_chunk is None:
+            pipe.mset(chunk)
+        else:
+            write_chunk(pipe, chunk)
+        pipe.hset(BATCH_INIT_PROGRESS_KEY, mapping={'params': params, 'written': written})
+        pipe.execute()
+        logger.info(f"Batch init: {written}/{n} entries written")
+    return written - start
@@ -1,3 +1,6 @@
+import sys
+
+
 def get_replicas_from_env():
     try:
         with open(".env", "r") as env_file:
@@ -13,13 +16,28 @@ def generate_consumer_compose(num_consumers):
     for i in range(num_consumers):
         consumer_service = f"""
   rabbitmq-consumer-{i}:
-    build: ./rabbitmq-consumer
+    build:
+      context: .
+      dockerfile: rabbitmq-consumer/Dockerfile
     image: rabbitmq-consumer:latest
     restart: always
     environment: 
       - GATEWAY_URL=http://gateway:80
+      - ORDER_URL=http://order-service:5000
+      - STOCK_URL=http://stock-service:5000
+      - PAYMENT_URL=http://payment-service:5000
       - MQ_REPLICAS=${{REPLICAS}}
       - REPLICA_INDEX={i}
+      - CONSUMER_MODE=${{CONSUMER_MODE:-blocking}}
+      - PREFETCH_COUNT=${{PREFETCH_COUNT:-32}}
+      - EXECUTOR_WORKERS=${{EXECUTOR_WORKERS:-0}}
+      - ACK_BATCH_SIZE=${{ACK_BATCH_SIZE:-1}}
+      - SAGA_MODE=${{SAGA_MODE:-compensate}}
+      - WORK_STEALING=${{WORK_STEALING:-false}}
+      - PRICE_EVENTS_URL=redis://:redis@stock-db:6379/0
+    # The order database keeps the per-user sequence numbers used by work stealing
+    env_file:
+      - env/order_redis.env
     depends_on:
       - rabbitmq
 """
@@ -34,6 +52,7 @@ def write_to_file(file_path, content):
 
 
 if __name__ == "__main__":
-    num_consumers = get_replicas_from_env()  # Change this to the desired number of consumers
+    # The number of consumers can be given as an argument, e.g. to add a replica before growing the queue ring
+    num_consumers = int(sys.argv[1]) if len(sys.argv) > 1 else get_replicas_from_env()
     compose_content = generate_consumer_compose(num_consumers)
     write_to_file("consumer-compose.yml", compose_content)
\ No newline at end of file
@@ -1,11 +1,15 @@
-import hashlib
 import logging
 import os
 import atexit
+import functools
 import random
 import uuid
 from collections import defaultdict
+from contextlib import contextmanager
+from queue import SimpleQueue, Empty
 import threading
+from itertools import chain
+from typing import Callable, Iterator
 import time
 import json
 
@@ -13,20 +17,61 @@ import redis
 import requests
 
 from msgspec import msgpack, Struct
-from flask import Flask, jsonify, abort, Response
+from flask import Flask, jsonify, abort, Response, request
 import pika
 
+from common.messages import TaskMessage, StatusMessage, MSGPACK, encode, decode, DecodeError
+from common.hashring import HashRing, queue_names, barrier_id, HANDOFF_BARRIER
+from common.metrics import Gauge, Histogram, instrument_app, instrument_redis
+from common.service import (BATCH_INIT_PROGRESS_KEY, IDEMPOTENCY_TTL, batch_init_chunked, batch_response,
+                            check_redis_maxclients, connect_redis, get_ids_from_request, idempotency_record_key)
+
 DB_ERROR_STR = "DB error"
 REQ_ERROR_STR = "Requests error"
 N_QUEUES = os.environ['MQ_REPLICAS']
 GATEWAY_URL = os.environ['GATEWAY_URL']
+STOCK_URL = os.environ.get('STOCK_URL', f"{GATEWAY_URL}/stock")
+
+# Status messages are written to Redis and acknowledged in batches of up to STATUS_BATCH_SIZE
+STATUS_BATCH_SIZE = int(os.environ.get('STATUS_BATCH_SIZE', 256))
+STATUS_FLUSH_INTERVAL = float(os.environ.get('STATUS_FLUSH_INTERVAL', 0.05))
+STATUS_TTL = int(os.environ.get('STATUS_TTL', 24 * 60 * 60))
+STATUS_LAG_INTERVAL = float(os.environ.get('STATUS_LAG_INTERVAL', 1))
+# Upper bound for the ?wait= of the long-poll and stream status endpoints, below the gunicorn timeout
+STATUS_MAX_WAIT = float(os.environ.get('STATUS_MAX_WAIT', 25))
+
+# Hash with the epoch and size of the consistent hash ring of the main queues, and the size of the previous ring
+# while a ring change is handed off. MQ_REPLICAS is the size of the ring until it is changed with POST /ring
+QUEUE_RING_KEY = "queue_ring"
+# Every worker reads the ring from Redis at most once per RING_REFRESH_INTERVAL seconds
+RING_REFRESH_INTERVAL = float(os.environ.get('RING_REFRESH_INTERVAL', 1))
+
+# Number the messages of every user, so consumers that steal messages from each other's queues keep them in order
+WORK_STEALING = os.environ.get('WORK_STEALING', 'false') == 'true'
+USER_SEQUENCE_PREFIX = "user_seq:"
+
+# Hash of order_id -> user_id, so messages can be routed without reading the order
+ORDER_USER_KEY = "order_user"
+ROUTING_CACHE_SIZE = int(os.environ.get('ROUTING_CACHE_SIZE', 100_000))
+# Embed a snapshot of the order in checkout messages, so the consumer does not have to read the order back
+CHECKOUT_SNAPSHOT = os.environ.get('CHECKOUT_SNAPSHOT', 'false') == 'true'
+# Content type of the published messages, application/msgpack or application/json
+MESSAGE_FORMAT = os.environ.get('MESSAGE_FORMAT', MSGPACK)
 
 app = Flask("order-service")
 
-db: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST'],
-                              port=int(os.environ['REDIS_PORT']),
-                              password=os.environ['REDIS_PASSWORD'],
-                              db=int(os.environ['REDIS_DB']))
+db: redis.Redis = connect_redis()
+
+# Every gunicorn worker keeps its own metrics. With METRICS_DIR set, /metrics answers with the sum of all workers
+METRICS_DIR = os.environ.get('METRICS_DIR')
+instrument_app(app, directory=METRICS_DIR)
+instrument_redis(db)
+PUBLISH_DURATION = Histogram("queue_publish_duration_seconds",
+                             "Time from handing a message to the publisher thread until it was written to RabbitMQ",
+                             ("function",))
+# Every worker consumes the same status queue and sees the same lag, so the workers are not added up
+STATUS_LAG = Gauge("status_queue_lag", "Status messages waiting in the status queue", multiprocess_mode="max")
+STATUS_PENDING = Gauge("status_batch_pending", "Status messages received but not written to Redis yet")
 
 
 class Publisher(threading.Thread):
@@ -57,15 +102,18 @@ class Publisher(threading.Thread):
                     self.restart()
                 self.connect()
 
-    def _publish(self, message, queue, correlation_id="", reply_to=""):
+    def _publish(self, body: bytes, queue, correlation_id="", reply_to="", function="", queued_at=None):
         self.channel.basic_publish(
             exchange="",
             routing_key=str(queue),
-            body=message.encode(),
+            body=body,
             properties=pika.BasicProperties(
+                content_type=MESSAGE_FORMAT,
                 delivery_mode=2,
                 correlation_id=correlation_id,
                 reply_to=reply_to))
+        if queued_at is not None:
+            PUBLISH_DURATION.labels(function).observe(time.perf_counter() - queued_at)
 
     def connect(self):
         while True:
@@ -81,12 +129,15 @@ class Publisher(threading.Thread):
                 time.sleep(5)
                 self.connect()
 
-    def publish(self, message, queue, correlation_id="", reply_to=""):
+    def publish(self, message: TaskMessage, queue, correlation_id="", reply_to=""):
+        body = encode(message, MESSAGE_FORMAT)
         if not self.connection.is_open:
             self.connect()
+        queued_at = time.perf_counter()
         while True:
             try:
-                self.connection.add_callback_threadsafe(lambda: self._publish(message, queue, correlation_id, reply_to))
+                self.connection.add_callback_threadsafe(
+                    lambda: self._publish(body, queue, correlation_id, reply_to, message.function, queued_at))
             except pika.exceptions.ConnectionClosed:
                 print("Connection closed, reconnecting...")
                 self.connect()
@@ -103,19 +154,34 @@ class Publisher(threading.Thread):
         print("Stopped")
 
     @staticmethod
+    @functools.lru_cache(maxsize=ROUTING_CACHE_SIZE)
     def get_user_id(order_id):
-        order_entry: OrderValue = get_order_from_db(order_id)
-        return order_entry.user_id
+        """Look up the user of an order in the routing index. The user of an order never changes, so it is cached."""
+        try:
+            user_id: bytes = db.hget(ORDER_USER_KEY, order_id)
+        except redis.exceptions.RedisError:
+            return abort(400, DB_ERROR_STR)
+        if user_id is None:
+            # Order written before the routing index existed, add it to the index
+            user_id = get_order_from_db(order_id).user_id
+            db.hset(ORDER_USER_KEY, order_id, user_id)
+            return user_id
+        return user_id.decode()
+
+    def get_queue_for_order(self, key) -> tuple[str, str | None]:
+        """Get the queue for the given key (e.g. order_id or user_id) and the handoff barrier to wait for, if any."""
+        return queue_router.queue_for(key)
 
-    def get_queue_for_order(self, key):
-        """Get the queue for the given key. E.g. order_id or user_id."""
-        return self.queues[int(hashlib.md5(key.encode()).hexdigest(), 16) % int(N_QUEUES)]
+    def declare(self, queues: list[str]):
+        """Declare the queues that were added to the ring after the publisher connected."""
+        new_queues = [queue for queue in queues if queue not in self.queues]
+        self.queues.extend(new_queues)
+        for queue in new_queues:
+            self.connection.add_callback_threadsafe(functools.partial(self.channel.queue_declare, queue, durable=True))
 
 
 def create_connection():
-    queues = []
-    for i in range(int(N_QUEUES)):
-        queues.append(f"main_{i}")
+    queues = queue_names(int(N_QUEUES))
     while True:
         try:
             publisher = Publisher(queues)
@@ -130,8 +196,91 @@ def create_connection():
 publisher = create_connection()
 
 
-class RequestStatus(Struct):
-    status: str
+# Request statuses are stored as a one-byte code under their own key prefix, each with a TTL of STATUS_TTL
+STATUS_KEY_PREFIX = "status:"
+REQUEST_STATUS_CODES = {'Pending': b'P', 'Processed': b'S', 'Failed': b'F', 'Retrying': b'R'}
+REQUEST_STATUSES = {code: status for status, code in REQUEST_STATUS_CODES.items()}
+FINAL_STATUSES = ('Processed', 'Failed')
+
+
+def status_key(correlation_id: str) -> str:
+    return f"{STATUS_KEY_PREFIX}{correlation_id}"
+
+
+class QueueRouter:
+    """Routes users to the main queues with a consistent hash ring, which all workers share through Redis.
+
+    While a ring change is handed off, a user whose queue changed is routed to its new queue right away, but its
+    messages name the barrier of its previous queue, and the consumer holds them until that barrier has been processed.
+    So they can not overtake the messages of the user that are still waiting in the previous queue, and no message of
+    the user enters the previous queue after its barrier.
+    """
+
+    def __init__(self, replicas: int):
+        self.lock = threading.Lock()
+        self.default_replicas = replicas
+        self.epoch = -1
+        self.ring = HashRing(queue_names(replicas))
+        self.previous_ring: HashRing | None = None
+        # Queues of the previous ring whose barrier has been processed
+        self.drained: set[str] = set()
+        self.refreshed = 0.0
+
+    def get_state(self) -> dict[str, int]:
+        state = db.hgetall(QUEUE_RING_KEY)
+        if not state:
+            return {'epoch': 0, 'replicas': self.default_replicas, 'previous_replicas': 0}
+        return {key.decode(): int(value) for key, value in state.items()}
+
+    def refresh(self):
+        state = self.get_state()
+        if state['epoch'] != self.epoch:
+            self.epoch = state['epoch']
+            self.ring = HashRing(queue_names(state['replicas']))
+            self.previous_ring = HashRing(queue_names(state['previous_replicas'])) \
+                if state['previous_replicas'] else None
+            publisher.declare(self.ring.nodes)
+        if self.previous_ring is not None:
+            pending = pending_barriers(state)
+            self.drained = set(self.previous_ring.nodes) - set(pending)
+            if not pending:
+                finish_handoff(self.epoch)
+                self.previous_ring = None
+        self.refreshed = time.monotonic()
+
+    def queue_for(self, user_id: str) -> tuple[str, str | None]:
+        """The queue of the user, and the barrier its messages have to wait for if it is being handed off."""
+        with self.lock:
+            if time.monotonic() - self.refreshed > RING_REFRESH_INTERVAL:
+                self.refresh()
+            queue = self.ring.node_for(user_id)
+            if self.previous_ring is not None:
+                previous_queue = self.previous_ring.node_for(user_id)
+                if previous_queue != queue and previous_queue not in self.drained:
+                    return queue, barrier_id(self.epoch, previous_queue)
+            return queue, None
+
+
+def pending_barriers(state: dict[str, int]) -> list[str]:
+    """Queues of the previous ring whose barrier has not been processed yet."""
+    if not state['previous_replicas']:
+        return []
+    queues = queue_names(state['previous_replicas'])
+    codes = db.mget([status_key(barrier_id(state['epoch'], queue)) for queue in queues])
+    return [queue for queue, code in zip(queues, codes) if code != REQUEST_STATUS_CODES['Processed']]
+
+
+def finish_handoff(epoch: int):
+    """Forget the previous ring once every barrier of ring `epoch` has been processed."""
+    def transaction(pipe: redis.client.Pipeline):
+        if int(pipe.hget(QUEUE_RING_KEY, 'epoch') or 0) == epoch:
+            pipe.multi()
+            pipe.hset(QUEUE_RING_KEY, 'previous_replicas', 0)
+
+    db.transaction(transaction, QUEUE_RING_KEY)
+
+
+queue_router = QueueRouter(int(N_QUEUES))
 
 
 class Consumer(threading.Thread):
@@ -140,30 +289,63 @@ class Consumer(threading.Thread):
         self.daemon = True
         self.queue = queue
         self.is_running = True
+        # status key -> status code of the messages received since the last flush
+        self.batch: dict[str, bytes] = {}
+        self.last_delivery_tag = None
+        # Number of status messages waiting in the queue
+        self.lag = 0
+        self.lag_updated = 0.0
 
         parameters = pika.ConnectionParameters("rabbitmq")
         self.connection = pika.BlockingConnection(parameters)
         self.channel = self.connection.channel()
+        self.channel.basic_qos(prefetch_count=STATUS_BATCH_SIZE)
         self.channel.queue_declare(queue=self.queue, durable=True)
 
     def run(self):
         self.channel.basic_consume(queue=self.queue, on_message_callback=self.callback)
         while self.is_running:
-            self.connection.process_data_events(time_limit=1)
+            self.connection.process_data_events(time_limit=STATUS_FLUSH_INTERVAL)
+            self.flush()
+            if time.monotonic() - self.lag_updated > STATUS_LAG_INTERVAL:
+                self.update_lag()
 
     def callback(self, ch, method, properties, body):
-        status_data = json.loads(body)
-        key = status_data['correlation_id']
-        status = status_data['status']
-
-        value = msgpack.encode(RequestStatus(status=status))
+        self.last_delivery_tag = method.delivery_tag
         try:
-            db.set(key, value)
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            app.logger.debug(f'Request {key} is updated to {status}')
+            status_message: StatusMessage = decode(body, StatusMessage, properties.content_type)
+        except DecodeError:
+            print(f"Invalid status message: {body}")
+        else:
+            # A later status of the same request replaces the earlier one. The status was validated by decode
+            self.batch[status_key(status_message.correlation_id)] = REQUEST_STATUS_CODES[status_message.status]
+        if len(self.batch) >= STATUS_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.last_delivery_tag is None:
+            return
+        try:
+            # The batch is empty if every message in it was invalid
+            if self.batch:
+                pipe = db.pipeline(transaction=False)
+                pipe.mset(self.batch)
+                for key, code in self.batch.items():
+                    pipe.expire(key, STATUS_TTL)
+                    # Wake up the requests waiting for this status, see StatusWaiters
+                    pipe.publish(key, code)
+                pipe.execute()
+            self.channel.basic_ack(delivery_tag=self.last_delivery_tag, multiple=True)
+            app.logger.debug(f'{len(self.batch)} requests are updated')
         except redis.exceptions.RedisError:
             print(DB_ERROR_STR)
-            ch.basic_nack(delivery_tag=method.delivery_tag)
+            self.channel.basic_nack(delivery_tag=self.last_delivery_tag, multiple=True)
+        self.batch = {}
+        self.last_delivery_tag = None
+
+    def update_lag(self):
+        self.lag = self.channel.queue_declare(queue=self.queue, durable=True, passive=True).method.message_count
+        self.lag_updated = time.monotonic()
 
     def stop(self):
         print("Stopping...")
@@ -187,6 +369,45 @@ def create_status_connection():
 
 # Initialize Consumer connection
 consumer = create_status_connection()
+STATUS_LAG.set_function(lambda: consumer.lag)
+STATUS_PENDING.set_function(lambda: len(consumer.batch))
+
+
+class StatusWaiters:
+    """Hands the status updates that the status consumer publishes to the requests waiting for them.
+
+    A single pattern subscription per worker receives every update and puts it in the queue of each request waiting
+    for that correlation id, so waiting requests do not need a Redis connection of their own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters: dict[str, list[SimpleQueue]] = defaultdict(list)
+        self.pubsub = db.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.psubscribe(**{f"{STATUS_KEY_PREFIX}*": self.notify})
+        self.thread = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def notify(self, message):
+        with self.lock:
+            for waiter in self.waiters.get(message['channel'].decode(), ()):
+                waiter.put(REQUEST_STATUSES[message['data']])
+
+    @contextmanager
+    def subscribe(self, correlation_id: str) -> Iterator[SimpleQueue]:
+        key = status_key(correlation_id)
+        waiter = SimpleQueue()
+        with self.lock:
+            self.waiters[key].append(waiter)
+        try:
+            yield waiter
+        finally:
+            with self.lock:
+                self.waiters[key].remove(waiter)
+                if not self.waiters[key]:
+                    del self.waiters[key]
+
+
+status_waiters = StatusWaiters()
 
 
 def close_db_connection():
@@ -206,46 +427,184 @@ atexit.register(close_db_connection)
 
 class OrderValue(Struct):
     paid: bool
-    items: list[tuple[str, int]]
+    # Quantity per item. Orders written before items were aggregated hold a list with a line per addItem, which is
+    # converted when the order is read and saved in the new form by the next write of the blob
+    items: dict[str, int] | list[tuple[str, int]]
     user_id: str
     total_cost: int
+    # Incremented on every change of the order, so a checkout can detect that its snapshot is outdated
+    version: int = 0
+
+
+order_decoder = msgpack.Decoder(OrderValue)
+
+# Added items are not written into the OrderValue blob. Each addItem increments the quantity of the item in a hash
+# and the total cost and version in another, so it costs O(1) no matter how large the order is. The blob and the two
+# hashes together are the order; checkoutProcess folds the added items back into the blob.
+ORDER_ITEMS_PREFIX = "order_items:"
+ORDER_META_PREFIX = "order_meta:"
+
+# KEYS = idempotency record ('' for requests without a key), order, order meta, order items.
+# ARGV = idempotency TTL, item id, quantity, cost of the quantity.
+# Returns {status, total_cost}: status 0 = added, 1 = order not found, 2 = added before with the same idempotency key.
+# The meta hash is created from the blob on the first add after the order was created or folded.
+ADD_ITEM_LUA = """
+if KEYS[1] ~= '' and redis.call('EXISTS', KEYS[1]) == 1 then
+    return {2, 0}
+end
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    local entry = redis.call('GET', KEYS[2])
+    if not entry then
+        return {1, 0}
+    end
+    local order = cmsgpack.unpack(entry)
+    redis.call('HSET', KEYS[3], 'total_cost', order['total_cost'], 'version', order['version'] or 0)
+end
+redis.call('HINCRBY', KEYS[4], ARGV[2], ARGV[3])
+local total_cost = redis.call('HINCRBY', KEYS[3], 'total_cost', ARGV[4])
+redis.call('HINCRBY', KEYS[3], 'version', 1)
+if KEYS[1] ~= '' then
+    redis.call('SET', KEYS[1], 1, 'EX', ARGV[1])
+end
+return {0, total_cost}
+"""
+
+ITEM_ADDED = 0
+ORDER_NOT_FOUND = 1
+ITEM_ALREADY_ADDED = 2
+
+add_item_script = db.register_script(ADD_ITEM_LUA)
+
+
+def order_keys(order_id: str) -> tuple[str, str, str]:
+    return order_id, f"{ORDER_META_PREFIX}{order_id}", f"{ORDER_ITEMS_PREFIX}{order_id}"
+
+
+def read_order(pipe: redis.client.Pipeline, order_id: str):
+    """Queue (or, on a watching pipeline, run) the reads of everything that makes up an order."""
+    key, meta_key, items_key = order_keys(order_id)
+    return pipe.get(key), pipe.hgetall(meta_key), pipe.hgetall(items_key)
+
+
+def aggregate_items(lines: list[tuple[str, int]]) -> dict[str, int]:
+    items: dict[str, int] = {}
+    for item_id, quantity in lines:
+        items[item_id] = items.get(item_id, 0) + quantity
+    return items
+
+
+def materialize_order(entry: bytes | None, meta: dict[bytes, bytes], added: dict[bytes, bytes]) -> OrderValue | None:
+    if not entry:
+        return None
+    order_entry: OrderValue = order_decoder.decode(entry)
+    if isinstance(order_entry.items, list):
+        order_entry.items = aggregate_items(order_entry.items)
+    if meta:
+        for item_id, quantity in added.items():
+            item_id = item_id.decode()
+            order_entry.items[item_id] = order_entry.items.get(item_id, 0) + int(quantity)
+        order_entry.total_cost = int(meta[b'total_cost'])
+        order_entry.version = int(meta[b'version'])
+    return order_entry
 
 
 def get_order_from_db(order_id: str) -> OrderValue | None:
     try:
-        # get serialized data
-        entry: bytes = db.get(order_id)
+        # read the blob and the added lines in one MULTI, so they are consistent with each other
+        pipe = db.pipeline()
+        read_order(pipe, order_id)
+        entry: OrderValue | None = materialize_order(*pipe.execute())
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
-    # deserialize data if it exists else return null
-    entry: OrderValue | None = msgpack.decode(entry, type=OrderValue) if entry else None
     if entry is None:
         # if order does not exist in the database; abort
         abort(400, f"Order: {order_id} not found!")
     return entry
 
 
-def get_status_from_db(status_id: str) -> RequestStatus | None:
+def update_order_once(order_id: str, update: Callable[[OrderValue], None]) -> OrderValue | None:
+    """Apply `update` to an order and save it in one WATCH/MULTI transaction, together with a record of the
+    Idempotency-Key of the request. The added item lines are folded into the saved blob.
+
+    Returns the updated order, or None if a request with the same Idempotency-Key was applied before.
+    """
+    record_key = idempotency_record_key()
+    key, meta_key, items_key = order_keys(order_id)
+
+    def transaction(pipe: redis.client.Pipeline) -> OrderValue | None:
+        if record_key and pipe.exists(record_key):
+            return None
+        order_entry = materialize_order(*read_order(pipe, order_id))
+        if order_entry is None:
+            # if order does not exist in the database; abort
+            abort(400, f"Order: {order_id} not found!")
+        update(order_entry)
+        pipe.multi()
+        pipe.set(key, msgpack.encode(order_entry))
+        pipe.delete(meta_key, items_key)
+        if record_key:
+            pipe.set(record_key, 1, ex=IDEMPOTENCY_TTL)
+        return order_entry
+
+    watched = [key, meta_key, items_key, record_key] if record_key else [key, meta_key, items_key]
+    return db.transaction(transaction, *watched, value_from_callable=True)
+
+
+def store_pending(correlation_id: str, user_id: str) -> int | None:
+    """Store the Pending status of a new request and, with WORK_STEALING, draw the next sequence number of the user.
+
+    The status is stored before the message is published, so it cannot overwrite the status written by the consumer.
+    """
+    pipe = db.pipeline(transaction=False)
+    pipe.set(status_key(correlation_id), REQUEST_STATUS_CODES['Pending'], ex=STATUS_TTL)
+    if WORK_STEALING:
+        pipe.incr(f"{USER_SEQUENCE_PREFIX}{user_id}")
+    results = pipe.execute()
+    return results[1] if WORK_STEALING else None
+
+
+def get_status_from_db(correlation_id: str) -> str | None:
     try:
-        entry: bytes = db.get(status_id)
-        app.logger.debug(f"get status from db: entry is {entry}")
+        entry: bytes = db.get(status_key(correlation_id))
     except redis.exceptions.RedisError:
-        app.logger.debug(f"get status from db: entry is and error")
         return abort(400, DB_ERROR_STR)
-    app.logger.debug(f"get status from db: entry is {entry}")
-    entry: RequestStatus | None = msgpack.decode(entry, type=RequestStatus) if entry else None
-    app.logger.debug(f"DECODED get status from db: entry is {entry}")
     if entry is None:
-        abort(400, f"Status: {status_id} not found!")
-    return entry
+        abort(400, f"Status: {correlation_id} not found!")
+    return REQUEST_STATUSES[entry]
+
+
+def iter_statuses(correlation_id: str, timeout: float) -> Iterator[str]:
+    """Yield the current status of a request and every update after it, until it is final or the timeout passed."""
+    # Subscribe before reading the current status, so an update in between is not missed
+    with status_waiters.subscribe(correlation_id) as updates:
+        status = get_status_from_db(correlation_id)
+        yield status
+        deadline = time.monotonic() + timeout
+        while status not in FINAL_STATUSES:
+            try:
+                status = updates.get(timeout=max(0.0, deadline - time.monotonic()))
+            except Empty:
+                return
+            yield status
+
+
+def get_wait_from_request() -> float:
+    """Read ?wait=<seconds> (e.g. 5 or 5s), capped at STATUS_MAX_WAIT."""
+    try:
+        return min(float(request.args.get('wait', '0').removesuffix('s')), STATUS_MAX_WAIT)
+    except ValueError:
+        abort(400, "Invalid wait, expected a number of seconds")
 
 
 @app.post('/create/<user_id>')
 def create_order(user_id: str):
     key = str(uuid.uuid4())
-    value = msgpack.encode(OrderValue(paid=False, items=[], user_id=user_id, total_cost=0))
+    value = msgpack.encode(OrderValue(paid=False, items={}, user_id=user_id, total_cost=0))
     try:
-        db.set(key, value)
+        pipe = db.pipeline()
+        pipe.set(key, value)
+        pipe.hset(ORDER_USER_KEY, key, user_id)
+        pipe.execute()
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
     return jsonify({'order_id': key})
@@ -263,18 +622,38 @@ def batch_init_users(n: int, n_items: int, n_users: int, item_price: int):
         item1_id = random.randint(0, n_items - 1)
         item2_id = random.randint(0, n_items - 1)
         value = OrderValue(paid=False,
-                           items=[(f"{item1_id}", 1), (f"{item2_id}", 1)],
+                           items=aggregate_items([(f"{item1_id}", 1), (f"{item2_id}", 1)]),
                            user_id=f"{user_id}",
                            total_cost=2 * item_price)
         return value
 
-    kv_pairs: dict[str, bytes] = {f"{i}": msgpack.encode(generate_entry())
-                                  for i in range(n)}
     try:
-        db.mset(kv_pairs)
+        written = batch_init_chunked(db, lambda _: generate_entry(), n,
+                                     f"orders/{n}/{n_items}/{n_users}/{item_price}",
+                                     request.args.get('resume', 'true') == 'true', app.logger, write_orders_chunk)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
-    return jsonify({"msg": "Batch init for orders successful"})
+    # The orders may have existed before with another user. Other workers keep routing those orders by the old user
+    # until their cache entry is evicted, which only changes the queue their messages go to
+    Publisher.get_user_id.cache_clear()
+    return jsonify({"msg": "Batch init for orders successful", "written": written})
+
+
+def write_orders_chunk(pipe: redis.client.Pipeline, chunk: dict[str, OrderValue]):
+    """Write a chunk of orders together with their routing index entries."""
+    pipe.mset({key: msgpack.encode(order) for key, order in chunk.items()})
+    # drop the items added to the orders that existed before under these ids
+    pipe.delete(*(key for order_id in chunk for key in order_keys(order_id)[1:]))
+    pipe.hset(ORDER_USER_KEY, mapping={key: order.user_id for key, order in chunk.items()})
+
+
+@app.get('/batch_init/progress')
+def batch_init_progress():
+    try:
+        progress = db.hgetall(BATCH_INIT_PROGRESS_KEY)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    return jsonify({key.decode(): value.decode() for key, value in progress.items()})
 
 
 @app.get('/find/<order_id>')
@@ -284,13 +663,35 @@ def find_order(order_id: str):
         {
             "order_id": order_id,
             "paid": order_entry.paid,
-            "items": order_entry.items,
+            "items": list(order_entry.items.items()),
             "user_id": order_entry.user_id,
             "total_cost": order_entry.total_cost
         }
     )
 
 
+@app.post('/find_batch')
+def find_orders():
+    """Find many orders with a single pipeline. Takes a list of order ids, answers with an order (or null) per id."""
+    order_ids = get_ids_from_request()
+    try:
+        pipe = db.pipeline(transaction=False)
+        for order_id in order_ids:
+            read_order(pipe, order_id)
+        replies = pipe.execute() if order_ids else []
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    orders = []
+    for i, order_id in enumerate(order_ids):
+        order: OrderValue | None = materialize_order(*replies[3 * i:3 * i + 3])
+        orders.append({"order_id": order_id,
+                       "paid": order.paid,
+                       "items": list(order.items.items()),
+                       "user_id": order.user_id,
+                       "total_cost": order.total_cost} if order else None)
+    return batch_response(orders)
+
+
 def send_post_request(url: str):
     try:
         response = requests.post(url)
@@ -313,16 +714,14 @@ def send_get_request(url: str):
 def add_item_request(order_id: str, item_id: str, quantity: int):
     correlation_id = str(uuid.uuid4())
     try:
-        message = json.dumps({
-            "function": "handle_add_item",
-            "args": [order_id, item_id, quantity]
-        })
-        queue = publisher.get_queue_for_order(publisher.get_user_id(order_id))
+        user_id = publisher.get_user_id(order_id)
+        queue, after = publisher.get_queue_for_order(user_id)
         if not publisher.connection.is_open:
             publisher.connect()
+        seq = store_pending(correlation_id, user_id)
+        message = TaskMessage(function="handle_add_item", args=[order_id, item_id, quantity], user_id=user_id,
+                              seq=seq, after=after)
         publisher.publish(message, queue, correlation_id, "status")
-        value = msgpack.encode(RequestStatus(status='Pending'))
-        db.set(correlation_id, value)
         return jsonify({"success": "Item addition request sent", "correlation_id": correlation_id}), 200
     except Exception as e:
         print(e)
@@ -334,27 +733,25 @@ def add_item_process(order_id: str, item_id: str, quantity: int, price: int):
     try:
         quantity = int(quantity)
         price = int(price)
-
-        order_entry: OrderValue = get_order_from_db(order_id)
-        if not order_entry:
-            return jsonify({"error": f"Order {order_id} not found"}), 404
-
-        order_entry.items.append((item_id, quantity))
-        order_entry.total_cost += quantity * price
-
+        record_key = idempotency_record_key()
         try:
-            db.set(order_id, msgpack.encode(order_entry))
+            status, total_cost = add_item_script(keys=[record_key, *order_keys(order_id)],
+                                                 args=[IDEMPOTENCY_TTL, item_id, quantity, quantity * price])
         except redis.exceptions.RedisError:
             return abort(400, DB_ERROR_STR)
-        return Response(f"Item: {item_id} added to: {order_id}, price updated to: {order_entry.total_cost}", status=200)
+        if status == ORDER_NOT_FOUND:
+            return abort(400, f"Order: {order_id} not found!")
+        if status == ITEM_ALREADY_ADDED:
+            return Response(f"Item: {item_id} already added to: {order_id}", status=200)
+        return Response(f"Item: {item_id} added to: {order_id}, price updated to: {total_cost}", status=200)
 
     except Exception as e:
         return jsonify({"error": "Failed to add item", "details": str(e)}), 500
 
 
-def rollback_stock(removed_items: list[tuple[str, int]]):
-    for item_id, quantity in removed_items:
-        send_post_request(f"{GATEWAY_URL}/stock/add/{item_id}/{quantity}")
+def rollback_stock(removed_items: dict[str, int]):
+    for item_id, quantity in removed_items.items():
+        send_post_request(f"{STOCK_URL}/add/{item_id}/{quantity}")
 
 
 @app.post('/checkout/<order_id>')
@@ -362,23 +759,24 @@ def checkout_request(order_id: str):
     app.logger.debug(f"Initiating checkout for order {order_id}")
     correlation_id = str(uuid.uuid4())
     try:
-        # # user_id from order
-        # order_entry: OrderValue = get_order_from_db(order_id)
-        # user_id = order_entry.user_id
         # Create Message
-        message = json.dumps({
-            "function": "handle_checkout",
-            "args": (order_id,)
-        })
+        if CHECKOUT_SNAPSHOT:
+            order_entry: OrderValue = get_order_from_db(order_id)
+            user_id = order_entry.user_id
+            args = [order_id, {"version": order_entry.version,
+                               "items": order_entry.items,
+                               "user_id": order_entry.user_id,
+                               "total_cost": order_entry.total_cost}]
+        else:
+            user_id = publisher.get_user_id(order_id)
+            args = [order_id]
+        seq = store_pending(correlation_id, user_id)
+        queue, after = publisher.get_queue_for_order(user_id)
+        message = TaskMessage(function="handle_checkout", args=args, user_id=user_id, seq=seq, after=after)
 
         # Publish Message
-        queue = publisher.get_queue_for_order(publisher.get_user_id(order_id))
         publisher.publish(message, queue, correlation_id, "status")
 
-        # Store request status
-        value = msgpack.encode(RequestStatus(status='Pending'))
-        db.set(correlation_id, value)
-
         return jsonify({"success": "Checkout request sent", "correlation_id": correlation_id}), 202
     except Exception as e:
         return jsonify({"error": "Failed to initiate checkout", "details": str(e)}), 500
@@ -388,15 +786,17 @@ def checkout_request(order_id: str):
 def checkout_process(order_id: str):
     app.logger.debug(f"Saving order {order_id}")
 
-    # Get Order
-    order_entry: OrderValue = get_order_from_db(order_id)
+    version = request.args.get('version')
 
-    # Update Order
-    order_entry.paid = True
+    def mark_paid(order_entry: OrderValue):
+        if version is not None and int(version) != order_entry.version:
+            abort(409, f"Order: {order_id} changed after the checkout was requested")
+        order_entry.paid = True
+        order_entry.version += 1
 
-    # Save Order
+    # Update and save the order, unless this checkout was saved before
     try:
-        db.set(order_id, msgpack.encode(order_entry))
+        update_order_once(order_id, mark_paid)
     except redis.exceptions.RedisError:
         return abort(500, DB_ERROR_STR)
 
@@ -407,16 +807,97 @@ def checkout_process(order_id: str):
 @app.get('/status/<correlation_id>')
 def get_status(correlation_id: str):
     app.logger.debug(f"GET request for {correlation_id}")
-    status_entry: RequestStatus = get_status_from_db(correlation_id)
-    app.logger.debug(f"GET request for {correlation_id} is {status_entry} ")
+    wait = get_wait_from_request()
+    if wait > 0:
+        # Long-poll: answer as soon as the request has a final status
+        *_, status = iter_statuses(correlation_id, wait)
+    else:
+        status = get_status_from_db(correlation_id)
+    app.logger.debug(f"GET request for {correlation_id} is {status} ")
     return jsonify(
         {
             "correlation_id": correlation_id,
-            "status": status_entry.status
+            "status": status
         }
     ), 200
 
 
+@app.get('/status/<correlation_id>/stream')
+def stream_status(correlation_id: str):
+    """Server-Sent Events stream of the status of a request, closed once the status is final."""
+    statuses = iter_statuses(correlation_id, get_wait_from_request() or STATUS_MAX_WAIT)
+    # Read the current status before the response starts, so an unknown correlation id still gets a 400
+    first_status = next(statuses)
+
+    def events():
+        for status in chain([first_status], statuses):
+            yield f"data: {json.dumps({'correlation_id': correlation_id, 'status': status})}\n\n"
+
+    return Response(events(), mimetype='text/event-stream')
+
+
+@app.get('/ring')
+def get_ring():
+    try:
+        state = queue_router.get_state()
+        pending = pending_barriers(state)
+        if state['previous_replicas'] and not pending:
+            finish_handoff(state['epoch'])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    return jsonify({**state, "pending_barriers": pending}), 200
+
+
+@app.post('/ring/<replicas>')
+def change_ring(replicas: int):
+    """Change the number of main queues and hand the users that move to another queue off without reordering.
+
+    Start the consumers of added queues before, and stop the consumers of removed queues only after the handoff
+    finished (GET /ring shows no pending barriers).
+    """
+    replicas = int(replicas)
+    if replicas < 1:
+        abort(400, "The ring needs at least one queue")
+
+    def transaction(pipe: redis.client.Pipeline) -> dict[str, int]:
+        state = queue_router.get_state()
+        if pending_barriers(state):
+            abort(409, "The previous ring change is still being handed off")
+        pipe.multi()
+        pipe.hset(QUEUE_RING_KEY, mapping={'epoch': state['epoch'] + 1,
+                                           'replicas': replicas,
+                                           'previous_replicas': state['replicas']})
+        return state
+
+    try:
+        state = db.transaction(transaction, QUEUE_RING_KEY, value_from_callable=True)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    epoch = state['epoch'] + 1
+    publisher.declare(queue_names(replicas))
+
+    # Workers that did not read the new ring yet still route moved users to their previous queue, workers that did
+    # route them to their new queue, where the consumer holds them until the barrier of the previous queue has been
+    # processed. The barriers are only published once every worker read the new ring, so every message of a moved user
+    # that entered its previous queue is in front of the barrier.
+    time.sleep(2 * RING_REFRESH_INTERVAL)
+    barriers = []
+    try:
+        for queue in queue_names(state['replicas']):
+            correlation_id = barrier_id(epoch, queue)
+            db.set(status_key(correlation_id), REQUEST_STATUS_CODES['Pending'], ex=STATUS_TTL)
+            publisher.publish(TaskMessage(function=HANDOFF_BARRIER, args=[epoch]), queue, correlation_id, "status")
+            barriers.append(correlation_id)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    return jsonify({"epoch": epoch, "replicas": replicas, "barriers": barriers}), 200
+
+
+@app.get('/status_lag')
+def get_status_lag():
+    return jsonify({"queue": consumer.queue, "lag": consumer.lag, "pending": len(consumer.batch)}), 200
+
+
 # @app.post('/checkout/failed/<order_id>')
 # def checkout_failed(order_id: str):
 #     return jsonify({"error": "Checkout failed"}), 500
@@ -428,3 +909,4 @@ else:
     gunicorn_logger = logging.getLogger('gunicorn.error')
     app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
+    check_redis_maxclients(db, app.logger)
@@ -1,22 +1,35 @@
 import logging
 import os
 import atexit
+import threading
+import time
 import uuid
 
 import redis
 
 from msgspec import msgpack, Struct
-from flask import Flask, jsonify, abort, Response
+from flask import Flask, jsonify, abort, Response, request
+
+from common.metrics import instrument_app, instrument_redis
+from common.reservations import (COMMIT_RESERVATION_LUA, EXISTING_RESERVATION_LUA, RESERVATION_COMMITTED,
+                                 RESERVATION_CONFLICT, RESERVATION_HELD, RESERVATION_NOT_FOUND, RESERVATION_TTL,
+                                 RESERVATIONS_KEY, release_expired_reservations, release_expired_reservations_lua,
+                                 release_reservation_lua, reservation_key)
+from common.service import (BATCH_INIT_PROGRESS_KEY, IDEMPOTENCY_KEY_REUSED, IDEMPOTENCY_KEY_REUSED_STR,
+                            IDEMPOTENCY_TTL, IDEMPOTENT_LUA, batch_init_chunked, batch_response,
+                            check_redis_maxclients, connect_redis, get_ids_from_request, idempotency_record_key)
 
 DB_ERROR_STR = "DB error"
 
 
 app = Flask("payment-service")
 
-db: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST'],
-                              port=int(os.environ['REDIS_PORT']),
-                              password=os.environ['REDIS_PASSWORD'],
-                              db=int(os.environ['REDIS_DB']))
+db: redis.Redis = connect_redis()
+
+# Every gunicorn worker keeps its own metrics. With METRICS_DIR set, /metrics answers with the sum of all workers
+METRICS_DIR = os.environ.get('METRICS_DIR')
+instrument_app(app, directory=METRICS_DIR)
+instrument_redis(db)
 
 
 def close_db_connection():
@@ -30,6 +43,64 @@ class UserValue(Struct):
     credit: int
 
 
+user_decoder = msgpack.Decoder(UserValue)
+
+# Atomically read-modify-write the msgpack encoded UserValue of a single user in one round trip, so concurrent
+# payments of the same user can not lose updates.
+# KEYS = idempotency record, user. ARGV = idempotency TTL, amount.
+# Returns {status, credit}: status 0 = updated, 1 = user not found, 2 = insufficient credit.
+UPDATE_CREDIT_LUA = """
+local function update()
+    local entry = redis.call('GET', KEYS[2])
+    if not entry then
+        return {1, 0}
+    end
+    local user = cmsgpack.unpack(entry)
+    local credit = user['credit'] + tonumber(ARGV[2])
+    if credit < 0 then
+        return {2, user['credit']}
+    end
+    user['credit'] = credit
+    redis.call('SET', KEYS[2], cmsgpack.pack(user))
+    return {0, credit}
+end
+""" + IDEMPOTENT_LUA
+
+# Same checks as UPDATE_CREDIT_LUA, but the subtracted amount is also recorded in a reservation hash
+# (KEYS[1], user id -> amount) and the reservation id is added to the expiry set (KEYS[2]) until it is committed,
+# released or expired. Reserving an id that is already reserved or committed with the same user and amount does
+# nothing, so a retried reserve is harmless; with another user or amount it is a conflict.
+# KEYS[3] = user. ARGV = expires_at, reservation id, amount.
+RESERVE_CREDIT_LUA = """
+local held = {KEYS[3], ARGV[3]}
+""" + EXISTING_RESERVATION_LUA + """
+local entry = redis.call('GET', KEYS[3])
+if not entry then
+    return {1, 0}
+end
+local user = cmsgpack.unpack(entry)
+local credit = user['credit'] - tonumber(ARGV[3])
+if credit < 0 then
+    return {2, user['credit']}
+end
+user['credit'] = credit
+redis.call('SET', KEYS[3], cmsgpack.pack(user))
+redis.call('HSET', KEYS[1], KEYS[3], ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[2])
+return {0, credit}
+"""
+
+CREDIT_UPDATED = 0
+USER_NOT_FOUND = 1
+INSUFFICIENT_CREDIT = 2
+
+update_credit_script = db.register_script(UPDATE_CREDIT_LUA)
+reserve_credit_script = db.register_script(RESERVE_CREDIT_LUA)
+release_credit_script = db.register_script(release_reservation_lua('credit'))
+release_expired_credit_script = db.register_script(release_expired_reservations_lua('credit'))
+commit_credit_script = db.register_script(COMMIT_RESERVATION_LUA)
+
+
 def get_user_from_db(user_id: str) -> UserValue | None:
     try:
         # get serialized data
@@ -59,13 +130,22 @@ def create_user():
 def batch_init_users(n: int, starting_money: int):
     n = int(n)
     starting_money = int(starting_money)
-    kv_pairs: dict[str, bytes] = {f"{i}": msgpack.encode(UserValue(credit=starting_money))
-                                  for i in range(n)}
+    value = msgpack.encode(UserValue(credit=starting_money))
+    try:
+        written = batch_init_chunked(db, lambda _: value, n, f"payment/{n}/{starting_money}",
+                                     request.args.get('resume', 'true') == 'true', app.logger)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    return jsonify({"msg": "Batch init for users successful", "written": written})
+
+
+@app.get('/batch_init/progress')
+def batch_init_progress():
     try:
-        db.mset(kv_pairs)
+        progress = db.hgetall(BATCH_INIT_PROGRESS_KEY)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
-    return jsonify({"msg": "Batch init for users successful"})
+    return jsonify({key.decode(): value.decode() for key, value in progress.items()})
 
 
 @app.get('/find_user/<user_id>')
@@ -79,31 +159,111 @@ def find_user(user_id: str):
     )
 
 
-@app.post('/add_funds/<user_id>/<amount>')
-def add_credit(user_id: str, amount: int):
-    user_entry: UserValue = get_user_from_db(user_id)
-    # update credit, serialize and update database
-    user_entry.credit += int(amount)
+@app.post('/find_users')
+def find_users():
+    """Find many users with a single MGET. Takes a list of user ids, answers with a user (or null) per id."""
+    user_ids = get_ids_from_request()
+    try:
+        entries: list[bytes | None] = db.mget(user_ids) if user_ids else []
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    users = []
+    for user_id, entry in zip(user_ids, entries):
+        user: UserValue | None = user_decoder.decode(entry) if entry else None
+        users.append({"user_id": user_id, "credit": user.credit} if user else None)
+    return batch_response(users)
+
+
+def get_amount(amount: str) -> int:
+    """Read an amount from the url. Orders without items are paid with 0, a negative amount would add credit."""
+    try:
+        amount = int(amount)
+    except ValueError:
+        abort(400, f"Amount: {amount} is not a number!")
+    if amount < 0:
+        abort(400, f"Amount: {amount} cannot be negative!")
+    return amount
+
+
+def update_credit(user_id: str, amount: int) -> tuple[int, int]:
     try:
-        db.set(user_id, msgpack.encode(user_entry))
+        status, credit = update_credit_script(keys=[idempotency_record_key(), user_id], args=[IDEMPOTENCY_TTL, amount])
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
-    return Response(f"User: {user_id} credit updated to: {user_entry.credit}", status=200)
+    if status == IDEMPOTENCY_KEY_REUSED:
+        abort(422, IDEMPOTENCY_KEY_REUSED_STR)
+    if status == USER_NOT_FOUND:
+        # if user does not exist in the database; abort
+        abort(400, f"User: {user_id} not found!")
+    return status, credit
+
+
+@app.post('/add_funds/<user_id>/<amount>')
+def add_credit(user_id: str, amount: int):
+    _, credit = update_credit(user_id, get_amount(amount))
+    return Response(f"User: {user_id} credit updated to: {credit}", status=200)
 
 
 @app.post('/pay/<user_id>/<amount>')
 def remove_credit(user_id: str, amount: int):
     app.logger.debug(f"Removing {amount} credit from user: {user_id}")
-    user_entry: UserValue = get_user_from_db(user_id)
-    # update credit, serialize and update database
-    user_entry.credit -= int(amount)
-    if user_entry.credit < 0:
+    status, credit = update_credit(user_id, -get_amount(amount))
+    if status == INSUFFICIENT_CREDIT:
+        abort(400, f"User: {user_id} credit cannot get reduced below zero!")
+    return Response(f"User: {user_id} credit updated to: {credit}", status=200)
+
+
+@app.post('/reserve/<reservation_id>/<user_id>/<amount>')
+def reserve_credit(reservation_id: str, user_id: str, amount: int):
+    """Subtract credit from a user and hold it until the reservation is committed or released.
+
+    A reservation that is neither committed nor released within RESERVATION_TTL seconds is released by the reaper.
+    """
+    amount = get_amount(amount)
+    try:
+        status, credit = reserve_credit_script(keys=[reservation_key(reservation_id), RESERVATIONS_KEY, user_id],
+                                               args=[time.time() + RESERVATION_TTL, reservation_id, amount])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if status == USER_NOT_FOUND:
+        abort(400, f"User: {user_id} not found!")
+    if status == INSUFFICIENT_CREDIT:
         abort(400, f"User: {user_id} credit cannot get reduced below zero!")
+    if status == RESERVATION_CONFLICT:
+        abort(409, f"Reservation: {reservation_id} already holds another amount!")
+    if status == RESERVATION_HELD:
+        return Response(f"Reservation: {reservation_id} already reserved", status=200)
+    if status == RESERVATION_COMMITTED:
+        return Response(f"Reservation: {reservation_id} already committed", status=200)
+    return Response(f"User: {user_id} credit reserved, credit left: {credit}", status=200)
+
+
+@app.post('/commit/<reservation_id>')
+def commit_credit(reservation_id: str):
+    try:
+        status = commit_credit_script(keys=[reservation_key(reservation_id), RESERVATIONS_KEY],
+                                      args=[reservation_id, IDEMPOTENCY_TTL])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if status == RESERVATION_NOT_FOUND:
+        abort(400, f"Reservation: {reservation_id} not found or expired!")
+    return Response(f"Reservation: {reservation_id} committed", status=200)
+
+
+@app.post('/release/<reservation_id>')
+def release_credit(reservation_id: str):
     try:
-        db.set(user_id, msgpack.encode(user_entry))
+        status = release_credit_script(keys=[reservation_key(reservation_id), RESERVATIONS_KEY],
+                                       args=[reservation_id])
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
-    return Response(f"User: {user_id} credit updated to: {user_entry.credit}", status=200)
+    if status == RESERVATION_NOT_FOUND:
+        abort(400, f"Reservation: {reservation_id} not found or expired!")
+    return Response(f"Reservation: {reservation_id} released", status=200)
+
+
+threading.Thread(target=release_expired_reservations, args=(release_expired_credit_script, app.logger),
+                 daemon=True).start()
 
 
 if __name__ == '__main__':
@@ -112,3 +272,4 @@ else:
     gunicorn_logger = logging.getLogger('gunicorn.error')
     app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
+    check_redis_maxclients(db, app.logger)
@@ -1,64 +1,261 @@
+import asyncio
+import itertools
 import logging
+import random
+import resource
 import time
 import threading
+import uuid
+from collections import OrderedDict
+from typing import Callable
+
+import redis
 import requests
-from collections import defaultdict
+from requests.adapters import HTTPAdapter
 import os
-from rabbitMQConsumer import RabbitMQConsumer, RequestStatusEnum
-import hashlib
+from rabbitMQConsumer import RabbitMQConsumer, AsyncRabbitMQConsumer, RequestStatusEnum, SequenceGate, \
+    current_correlation_id
+from common.hashring import HashRing, queue_names
+from common.metrics import Counter, Gauge, Histogram, serve as serve_metrics
 
 GATEWAY_URL = os.environ['GATEWAY_URL']
 N_QUEUES = os.environ['MQ_REPLICAS']
 REPLICA_INDEX = os.environ['REPLICA_INDEX']
+# "blocking" processes one message at a time per queue, "async" keeps PREFETCH_COUNT messages per queue in flight
+CONSUMER_MODE = os.environ.get('CONSUMER_MODE', 'blocking')
+PREFETCH_COUNT = int(os.environ.get('PREFETCH_COUNT', 32))
+# Threads running the sagas of the async consumer, 0 uses PREFETCH_COUNT (or 32 if that is 0, i.e. unlimited)
+EXECUTOR_WORKERS = int(os.environ.get('EXECUTOR_WORKERS', 0))
+# Number of processed messages that are acknowledged together with a single multiple=True ack
+ACK_BATCH_SIZE = int(os.environ.get('ACK_BATCH_SIZE', 1))
+# Status messages of the async consumer are published in batches with publisher confirms
+STATUS_BATCH_SIZE = int(os.environ.get('STATUS_BATCH_SIZE', 64))
+STATUS_FLUSH_INTERVAL = float(os.environ.get('STATUS_FLUSH_INTERVAL', 0.01))
+STATS_INTERVAL = int(os.environ.get('STATS_INTERVAL', 10))
+# "compensate" debits payment and stock directly and compensates on failure, "reserve" holds them with expiring
+# reservations that are committed once every step succeeded and released otherwise
+SAGA_MODE = os.environ.get('SAGA_MODE', 'compensate')
+# With work stealing every replica also consumes the main queues of the other replicas, at a lower priority, so it
+# only gets their messages while their own consumers are busy. The messages of a user are kept in order by the
+# sequence numbers the order service gives them, which are tracked in the order database.
+WORK_STEALING = os.environ.get('WORK_STEALING', 'false') == 'true'
+OWN_QUEUE_PRIORITY = 10
+STOLEN_QUEUE_PRIORITY = 0
+SEQUENCE_WAIT_TIMEOUT = float(os.environ.get('SEQUENCE_WAIT_TIMEOUT', 1))
+SEQUENCE_GAP_TIMEOUT = float(os.environ.get('SEQUENCE_GAP_TIMEOUT', 30))
+# A message of a user that was moved to another queue by a ring change waits until the handoff barrier of its previous
+# queue has been processed. A barrier that is not processed within HANDOFF_WAIT_TIMEOUT seconds is presumed lost.
+HANDOFF_WAIT_TIMEOUT = float(os.environ.get('HANDOFF_WAIT_TIMEOUT', 300))
+HANDOFF_POLL_WAIT = 5
+# handle_add_item caches item prices. The stock service publishes price changes on PRICE_CHANGES_CHANNEL of the
+# Redis at PRICE_EVENTS_URL; without it, or when an event is missed, a cached price is used for PRICE_CACHE_TTL seconds
+PRICE_CACHE_SIZE = int(os.environ.get('PRICE_CACHE_SIZE', 10_000))
+PRICE_CACHE_TTL = float(os.environ.get('PRICE_CACHE_TTL', 60))
+PRICE_EVENTS_URL = os.environ.get('PRICE_EVENTS_URL')
+PRICE_CHANGES_CHANNEL = "price_changes"
+ALL_ITEMS = "*"
+# GET /metrics on this port answers with the metrics of the consumer in the Prometheus text format
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+
+
+def round_robin(urls: str):
+    """Return a function cycling through the comma separated base urls of the replicas of a service."""
+    return itertools.cycle([url.strip().rstrip('/') for url in urls.split(',')]).__next__
+
+
+# Call the services directly, the gateway is only used when no service urls are configured
+order_url = round_robin(os.environ.get('ORDER_URL', f"{GATEWAY_URL}/orders"))
+stock_url = round_robin(os.environ.get('STOCK_URL', f"{GATEWAY_URL}/stock"))
+payment_url = round_robin(os.environ.get('PAYMENT_URL', f"{GATEWAY_URL}/payment"))
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_TIMEOUT = (float(os.environ.get('HTTP_CONNECT_TIMEOUT', 1)), float(os.environ.get('HTTP_READ_TIMEOUT', 10)))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.1))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 5))
+
+SAGA_STEP_DURATION = Histogram("saga_step_duration_seconds", "Latency of the saga steps, including their retries",
+                               ("step",))
+SAGA_COMPENSATIONS = Counter("saga_compensations_total", "Compensating requests sent, per step", ("step",))
+HTTP_RETRIES = Counter("consumer_http_retries_total", "Requests to the services that were retried", ("method",))
+PRICE_CACHE_LOOKUPS = Counter("price_cache_lookups_total", "Price cache lookups, per result", ("result",))
+PRICE_CACHE_INVALIDATIONS = Counter("price_cache_invalidations_total", "Price change events received")
+UNACKED_MESSAGES = Gauge("consumer_unacked_messages", "Delivered messages being processed or waiting for their ack",
+                         ("queue",))
+PEAK_RSS = Gauge("consumer_peak_rss_bytes", "Peak resident memory of the consumer process")
+
+# Every consumer thread keeps its own session, so connections to the services are reused between saga steps
+thread_local = threading.local()
 
 # Example function. You can put RabbitMQ, POST and GET requests to communicate with apps.
 def hello_world(hello, world):
     print(f"{hello}, {world}")
 
 
+# Only used for logging, the order service owns the ring and may have changed it since this consumer started
+queue_ring = HashRing(queue_names(int(N_QUEUES)))
+
+
 def get_queue_for_order(order_id):
-    return int(hashlib.md5(order_id.encode()).hexdigest(), 16) % int(N_QUEUES)
+    return queue_ring.node_for(order_id)
+
+
+def handoff_barrier(epoch):
+    # Processed after every message that was in the queue before it, see QueueRouter in the order service
+    print(f"Reached the handoff barrier of ring {epoch}")
+    return RequestStatusEnum.SUCCESS
+
+
+def wait_for_barrier(barrier: str):
+    """Wait until the handoff barrier has been processed, long-polling its status in the order service."""
+    deadline = time.monotonic() + HANDOFF_WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        # The status only exists once the barrier was published, which is a moment after the ring changed
+        response, status = get_request(f"{order_url()}/status/{barrier}?wait={HANDOFF_POLL_WAIT}")
+        if status.get('status') == 'Processed':
+            return
+        if response.status_code == 400:
+            time.sleep(RETRY_BASE_DELAY)
+    print(f"Handoff barrier {barrier} was not processed within {HANDOFF_WAIT_TIMEOUT}s, presuming it lost")
+
+
+def get_session() -> requests.Session:
+    session = getattr(thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        thread_local.session = session
+    return session
+
+
+def backoff(attempt: int):
+    """Exponential backoff with full jitter, so retrying consumers do not hit a recovering service in lockstep."""
+    time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
 
 
 def get_request(url):
+    attempt = 0
     while True:
         try:
-            response = requests.get(url)
+            response = get_session().get(url, timeout=HTTP_TIMEOUT)
             if response.status_code == 400:
                 print("GET request returned status code 400")
                 return response, {}
             response_json = response.json()
-        except (requests.exceptions.JSONDecodeError, requests.exceptions.ConnectionError):
+        except (requests.exceptions.JSONDecodeError, requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
             print("Target service down. Trying again later...")
-            time.sleep(3)
+            HTTP_RETRIES.labels('GET').inc()
+            backoff(attempt)
+            attempt += 1
         else:
             break
     return response, response_json
 
 
-def post_request(url):
+class PriceCache:
+    """Bounded LRU cache of item prices, so repeated adds of a hot item do not call the stock service."""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.prices: OrderedDict[str, tuple[int, float]] = OrderedDict()
+        # Incremented by every invalidation, so a price loaded while it changed is not cached
+        self.generation = 0
+        self.hits = PRICE_CACHE_LOOKUPS.labels('hit')
+        self.misses = PRICE_CACHE_LOOKUPS.labels('miss')
+
+    def get(self, item_id: str, load: Callable[[str], int | None]) -> int | None:
+        """The price of an item, calling `load` on a miss. Returns None for unknown items, which are not cached."""
+        with self.lock:
+            cached = self.prices.get(item_id)
+            if cached is not None and cached[1] > time.monotonic():
+                self.prices.move_to_end(item_id)
+                self.hits.inc()
+                return cached[0]
+            self.misses.inc()
+            generation = self.generation
+        price = load(item_id)
+        if price is None or self.size <= 0:
+            return price
+        with self.lock:
+            if generation == self.generation:
+                self.prices[item_id] = (price, time.monotonic() + self.ttl)
+                self.prices.move_to_end(item_id)
+                if len(self.prices) > self.size:
+                    self.prices.popitem(last=False)
+        return price
+
+    def invalidate(self, message):
+        item_id = message['data'].decode()
+        with self.lock:
+            self.generation += 1
+            PRICE_CACHE_INVALIDATIONS.inc()
+            if item_id == ALL_ITEMS:
+                self.prices.clear()
+            else:
+                self.prices.pop(item_id, None)
+
+    def subscribe(self, url: str):
+        pubsub = redis.Redis.from_url(url).pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{PRICE_CHANGES_CHANNEL: self.invalidate})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": int(self.hits.value()), "misses": int(self.misses.value()),
+                "invalidations": int(PRICE_CACHE_INVALIDATIONS.labels().value()), "size": len(self.prices)}
+
+
+price_cache = PriceCache(PRICE_CACHE_SIZE, PRICE_CACHE_TTL)
+if PRICE_EVENTS_URL:
+    price_cache.subscribe(PRICE_EVENTS_URL)
+
+
+def idempotency_key(step: str) -> str | None:
+    """Idempotency key of a saga step of the message being processed, the same when the message is redelivered."""
+    correlation_id = current_correlation_id.get()
+    return f"{correlation_id}:{step}" if correlation_id else None
+
+
+def post_request(url, json=None, idempotency_key=None, idempotent=False):
+    """POST to a service. Pass `idempotent=True` for endpoints that are idempotent without a key, like the
+    reservation endpoints, which apply a request once per reservation id."""
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key else None
+    # A read timeout is only retried for idempotent requests: the service may already have applied the request
+    retried = (requests.exceptions.ConnectionError, requests.exceptions.Timeout) if idempotency_key or idempotent \
+        else requests.exceptions.ConnectionError
+    attempt = 0
     while True:
         try:
-            response = requests.post(url)
+            response = get_session().post(url, json=json, headers=headers, timeout=HTTP_TIMEOUT)
             if response.status_code == 400:
                 print("POST request returned status code 400")
                 return response
-        except requests.exceptions.ConnectionError:
+        except retried:
             print("Target service down. Trying again later...")
-            time.sleep(3)
+            HTTP_RETRIES.labels('POST').inc()
+            backoff(attempt)
+            attempt += 1
         else:
             break
     return response
 
 
-def handle_add_item(order_id, item_id, quantity):
-    response, item_details = get_request(f"{GATEWAY_URL}/stock/find/{item_id.strip()}")
-    if response.status_code == 200:
-        item_details = response.json()
-        price = int(item_details['price'])
+def get_price(item_id: str) -> int | None:
+    with SAGA_STEP_DURATION.labels('find_item').time():
+        response, item_details = get_request(f"{stock_url()}/find/{item_id}")
+    return int(item_details['price']) if response.status_code == 200 else None
 
-        add_response = post_request(
-            f"{GATEWAY_URL}/orders/addItemProcess/{order_id.strip()}/{item_id.strip()}/{quantity.strip()}/{price}")
+
+def handle_add_item(order_id, item_id, quantity):
+    price = price_cache.get(item_id.strip(), get_price)
+    if price is not None:
+        with SAGA_STEP_DURATION.labels('add_item').time():
+            add_response = post_request(
+                f"{order_url()}/addItemProcess/{order_id.strip()}/{item_id.strip()}/{quantity.strip()}/{price}",
+                idempotency_key=idempotency_key('add_item'))
         if add_response.status_code == 200:
             print(f"Item {item_id} added {quantity} times successfully to order {order_id}")
             return RequestStatusEnum.SUCCESS
@@ -71,94 +268,241 @@ def handle_add_item(order_id, item_id, quantity):
         return RequestStatusEnum.FAIL
 
 
-def handle_checkout(order_id: str):
-    _, order_entry = get_request(f"{GATEWAY_URL}/orders/find/{order_id}")
+def handle_checkout(order_id: str, snapshot: dict | None = None):
+    # The order service may send a snapshot of the order along, which saves reading the order back
+    if snapshot is None:
+        with SAGA_STEP_DURATION.labels('find_order').time():
+            _, order_entry = get_request(f"{order_url()}/find/{order_id}")
+        version_query = ""
+    else:
+        order_entry = snapshot
+        version_query = f"?version={snapshot['version']}"
     user_id, items, total_cost = order_entry["user_id"], order_entry["items"], order_entry["total_cost"]
     print(f"Handling checkout for {order_id}, {items}, User:{user_id}")
 
-    # Calculate the quantity per item
-    items_quantities = defaultdict(int)
-    for item_id, quantity in items:
-        items_quantities[item_id] += quantity
+    # The order service keeps one quantity per item, as a map in snapshots and as [item_id, quantity] pairs in /find
+    items_quantities = dict(items)
+
+    if SAGA_MODE == 'reserve':
+        return checkout_with_reservations(order_id, user_id, items_quantities, total_cost, version_query)
 
-    removed_items = []
     paid = False
+    stock_removed = False
     try:
-        # Try to pay
-        payment_reply = post_request(f"{GATEWAY_URL}/payment/pay/{user_id}/{total_cost}")
+        # Try to pay. Every step carries an idempotency key, so on a redelivered message the services skip the
+        # steps that were applied before
+        with SAGA_STEP_DURATION.labels('pay').time():
+            payment_reply = post_request(f"{payment_url()}/pay/{user_id}/{total_cost}",
+                                         idempotency_key=idempotency_key('pay'))
         if payment_reply.status_code != 200:
             print(f"User out of credit: {user_id}")
             return RequestStatusEnum.FAIL
         else:
             paid = True
 
-        # Subtract stock for each item
-        for item_id, quantity in items_quantities.items():
-            stock_reply = post_request(f"{GATEWAY_URL}/stock/subtract/{item_id}/{quantity}")
-            if stock_reply.status_code != 200:
-                if paid:
-                    rollback_payment(user_id, total_cost)
-                rollback_stock(removed_items, order_id)
-                print(f"Out of stock on item_id: {item_id}")
-                return RequestStatusEnum.FAIL
-
-            removed_items.append((item_id, quantity))
-
-        # Update order status to paid
-        order_update_reply = post_request(f"{GATEWAY_URL}/orders/checkoutProcess/{order_id}")
-        if order_update_reply.status_code != 200:
-            if paid:
-                rollback_payment(user_id, total_cost)
-            rollback_stock(removed_items, order_id)
-            print(f"Failed to update order status: {order_id}")
-            return RequestStatusEnum.RETRY
+        # Subtract stock for all items at once, either every item is subtracted or none are
+        with SAGA_STEP_DURATION.labels('subtract').time():
+            stock_reply = post_request(f"{stock_url()}/subtract_batch", json=items_quantities,
+                                       idempotency_key=idempotency_key('subtract'))
+        if stock_reply.status_code != 200:
+            rollback_payment(user_id, total_cost)
+            print(f"Out of stock: {stock_reply.text}")
+            return RequestStatusEnum.FAIL
+        stock_removed = True
 
-        print(f"Checkout handled successfully: {order_id}, calculated queue: {get_queue_for_order(user_id)}")
-        return RequestStatusEnum.SUCCESS
+        return mark_order_paid(order_id, user_id, items_quantities, total_cost, version_query)
 
     except Exception as e:
         if paid:
             rollback_payment(user_id, total_cost)
-        rollback_stock(removed_items, order_id)
+        if stock_removed:
+            rollback_stock(items_quantities, order_id)
+        print(f"Failed to handle checkout: {str(e)}")
+        return RequestStatusEnum.FAIL
+
+
+def checkout_with_reservations(order_id: str, user_id: str, items_quantities: dict, total_cost: int,
+                               version_query: str):
+    """Checkout with reservations: a failed step only releases what was held, an abandoned checkout expires."""
+    # A redelivered message reuses its reservations, reserving and committing them again does nothing
+    reservation_id = current_correlation_id.get() or str(uuid.uuid4())
+    stock_reserved = False
+    payment_reserved = False
+    committed = False
+    try:
+        # Reserve the stock first, under contention it is what runs out and then nothing else was written
+        with SAGA_STEP_DURATION.labels('reserve_stock').time():
+            stock_reply = post_request(f"{stock_url()}/reserve/{reservation_id}", json=items_quantities,
+                                       idempotent=True)
+        if stock_reply.status_code != 200:
+            print(f"Out of stock: {stock_reply.text}")
+            return RequestStatusEnum.FAIL
+        stock_reserved = True
+
+        with SAGA_STEP_DURATION.labels('reserve_payment').time():
+            payment_reply = post_request(f"{payment_url()}/reserve/{reservation_id}/{user_id}/{total_cost}",
+                                         idempotent=True)
+        if payment_reply.status_code != 200:
+            release_reservations(reservation_id, stock=True, payment=False)
+            print(f"User out of credit: {user_id}")
+            return RequestStatusEnum.FAIL
+        payment_reserved = True
+
+        # A reservation only fails to commit if it expired, its stock or credit was then given back already
+        with SAGA_STEP_DURATION.labels('commit_stock').time():
+            stock_commit_reply = post_request(f"{stock_url()}/commit/{reservation_id}", idempotent=True)
+        if stock_commit_reply.status_code != 200:
+            release_reservations(reservation_id, stock=False, payment=True)
+            print(f"Stock reservation expired: {order_id}")
+            return RequestStatusEnum.RETRY
+        with SAGA_STEP_DURATION.labels('commit_payment').time():
+            payment_commit_reply = post_request(f"{payment_url()}/commit/{reservation_id}", idempotent=True)
+        if payment_commit_reply.status_code != 200:
+            rollback_stock(items_quantities, order_id)
+            print(f"Payment reservation expired: {order_id}")
+            return RequestStatusEnum.FAIL
+        committed = True
+
+        return mark_order_paid(order_id, user_id, items_quantities, total_cost, version_query)
+
+    except Exception as e:
+        if committed:
+            rollback_payment(user_id, total_cost)
+            rollback_stock(items_quantities, order_id)
+        else:
+            # Reservations that can not be released now expire after RESERVATION_TTL
+            release_reservations(reservation_id, stock=stock_reserved, payment=payment_reserved)
         print(f"Failed to handle checkout: {str(e)}")
         return RequestStatusEnum.FAIL
 
 
+def mark_order_paid(order_id: str, user_id: str, items_quantities: dict, total_cost: int, version_query: str):
+    """Last step of both sagas, the payment and stock of the order have been taken already."""
+    # Update order status to paid, if the order did not change after the snapshot was taken
+    with SAGA_STEP_DURATION.labels('checkout').time():
+        order_update_reply = post_request(f"{order_url()}/checkoutProcess/{order_id}{version_query}",
+                                          idempotency_key=idempotency_key('checkout'))
+    if order_update_reply.status_code == 409:
+        rollback_payment(user_id, total_cost)
+        rollback_stock(items_quantities, order_id)
+        print(f"Order changed after the checkout was requested, checking out the current order: {order_id}")
+        # The steps of the new checkout need keys of their own, the keys of this one were used already
+        current_correlation_id.set(idempotency_key('changed'))
+        return handle_checkout(order_id)
+    if order_update_reply.status_code != 200:
+        if idempotency_key('checkout') is None:
+            rollback_payment(user_id, total_cost)
+            rollback_stock(items_quantities, order_id)
+        # With idempotency keys the redelivered message skips payment and stock and only retries this step
+        print(f"Failed to update order status: {order_id}")
+        return RequestStatusEnum.RETRY
+
+    print(f"Checkout handled successfully: {order_id}, calculated queue: {get_queue_for_order(user_id)}")
+    return RequestStatusEnum.SUCCESS
+
+
+def release_reservations(reservation_id: str, stock: bool, payment: bool):
+    """Release what a failed checkout reserved. A release that fails is only logged: it is called while handling
+    failures, and a reservation that is not released expires after RESERVATION_TTL anyway."""
+    print(f"Releasing reservation: {reservation_id}")
+    for held, url, step in ((stock, stock_url, 'release_stock'), (payment, payment_url, 'release_payment')):
+        if not held:
+            continue
+        SAGA_COMPENSATIONS.labels(step).inc()
+        try:
+            with SAGA_STEP_DURATION.labels(step).time():
+                post_request(f"{url()}/release/{reservation_id}", idempotent=True)
+        except Exception as e:
+            print(f"Failed to release reservation {reservation_id} ({step}), it expires instead: {str(e)}")
+
+
 def rollback_payment(user_id: str, amount: int):
     print(f"Rolling back payment for user: {user_id}. Amount: {amount}")
-    response = post_request(f"{GATEWAY_URL}/payment/add_funds/{user_id}/{amount}")
+    SAGA_COMPENSATIONS.labels('refund').inc()
+    with SAGA_STEP_DURATION.labels('refund').time():
+        post_request(f"{payment_url()}/add_funds/{user_id}/{amount}", idempotency_key=idempotency_key('refund'))
 
 
-def rollback_stock(removed_items: list, order_id: str):
+def rollback_stock(items_quantities: dict, order_id: str):
     print(f"Rolling back stock for order: {order_id}")
-    for item_id, quantity in removed_items:
-        print(f"Rollback {item_id} {quantity} times")
-        _, current_stock = get_request(f"{GATEWAY_URL}/stock/find/{item_id}")
-        current_stock = current_stock["stock"]
-        print(f"Stock of {item_id} before rollback: {current_stock}")
-        response = post_request(f"{GATEWAY_URL}/stock/add/{item_id}/{quantity}")
-        print(f"Rollback response: {response.status_code}")
-        _, current_stock = get_request(f"{GATEWAY_URL}/stock/find/{item_id}")
-        current_stock = current_stock["stock"]
-        print(f"Stock of {item_id} after rollback: {current_stock}")
+    SAGA_COMPENSATIONS.labels('restock').inc()
+    with SAGA_STEP_DURATION.labels('restock').time():
+        response = post_request(f"{stock_url()}/add_batch", json=items_quantities,
+                                idempotency_key=idempotency_key('restock'))
+    print(f"Rollback response: {response.status_code}")
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def print_stats(unacked: dict[str, int]):
+    peak_rss = peak_rss_bytes() // (1024 * 1024)
+    print(f"Stats: unacked messages per queue {unacked}, peak RSS {peak_rss}MB, price cache {price_cache.stats()}")
+
+
+def export_stats(unacked: dict[str, int], queues):
+    """Report the unacked messages per queue and the peak memory on /metrics, read whenever they are collected."""
+    for queue in queues:
+        UNACKED_MESSAGES.labels(queue).set_function(lambda queue=queue: unacked.get(queue, 0))
+    PEAK_RSS.set_function(peak_rss_bytes)
+
 
+sequence_gate = SequenceGate(redis.Redis(host=os.environ['REDIS_HOST'],
+                                         port=int(os.environ['REDIS_PORT']),
+                                         password=os.environ['REDIS_PASSWORD'],
+                                         db=int(os.environ['REDIS_DB'])),
+                             SEQUENCE_WAIT_TIMEOUT, SEQUENCE_GAP_TIMEOUT) if WORK_STEALING else None
+
+consumer = RabbitMQConsumer(PREFETCH_COUNT, ACK_BATCH_SIZE, sequence_gate, wait_for_barrier)
+
+
+def get_queue_priorities() -> dict[str, int | None]:
+    """The queues to consume, with the consumer priority to consume them with."""
+    if not WORK_STEALING:
+        return {f'main_{REPLICA_INDEX}': None, f'test_{REPLICA_INDEX}': None}
+    queues = {f'main_{REPLICA_INDEX}': OWN_QUEUE_PRIORITY, f'test_{REPLICA_INDEX}': OWN_QUEUE_PRIORITY}
+    for i in range(int(N_QUEUES)):
+        queues.setdefault(f'main_{i}', STOLEN_QUEUE_PRIORITY)
+    return queues
+
+
+async def consume_async(queues: dict[str, int | None]):
+    async_consumer = AsyncRabbitMQConsumer(PREFETCH_COUNT, STATUS_BATCH_SIZE, STATUS_FLUSH_INTERVAL, sequence_gate,
+                                           wait_for_barrier, EXECUTOR_WORKERS)
+    export_stats(async_consumer.unacked, queues)
+
+    async def report_stats():
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            print_stats(async_consumer.unacked)
+
+    await asyncio.gather(report_stats(),
+                         *(async_consumer.consume_queue(q, globals(), priority) for q, priority in queues.items()))
 
-consumer = RabbitMQConsumer()
 
 if __name__ == '__main__':
     print("The number of queues is" + str(N_QUEUES))
-    queues = [f'main_{REPLICA_INDEX}', f'test_{REPLICA_INDEX}']
+    serve_metrics(METRICS_PORT)
+    queues = get_queue_priorities()
     threads = {}
 
-    for q in queues:
-        threads[q] = threading.Thread(target=consumer.consume_queue, args=(q, globals()), daemon=True)
-        threads[q].start()
+    if CONSUMER_MODE == 'async':
+        asyncio.run(consume_async(queues))
+    else:
+        export_stats(consumer.unacked, queues)
+        for q, priority in queues.items():
+            threads[q] = threading.Thread(target=consumer.consume_queue, args=(q, globals(), priority), daemon=True)
+            threads[q].start()
 
-    while True:
-        # Restart if heartbeat stopped
-        for q, t in threads.items():
-            if not t.is_alive():
-                threads[q] = threading.Thread(target=consumer.consume_queue, args=(q, globals()), daemon=True)
-                threads[q].start()
+        while True:
+            # Restart if heartbeat stopped
+            for q, t in threads.items():
+                if not t.is_alive():
+                    threads[q] = threading.Thread(target=consumer.consume_queue, args=(q, globals(), queues[q]),
+                                                  daemon=True)
+                    threads[q].start()
 
-        time.sleep(60)
+            print_stats(consumer.unacked)
+            time.sleep(STATS_INTERVAL)
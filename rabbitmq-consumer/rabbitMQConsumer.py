@@ -1,98 +1,395 @@
-import pika
-import json
-import time
-from enum import Enum
-
-class RabbitMQConsumer:
-    @staticmethod
-    def process(message: dict, functions: dict):
-        functions.update(globals())
-        if 'function' not in message.keys():
-            # Invalid request, do not retry
-            return RequestStatusEnum.FAIL
-        return functions[message['function']](*message['args'])
-
-    @staticmethod
-    def send_status(queue: str, message: dict, status_channel: pika.adapters.blocking_connection.BlockingChannel):
-        # Establish a connection and channel for sending status messages
-        status_channel.queue_declare(queue=queue, durable=True)
-
-        # Publish the status message
-        status_channel.basic_publish(
-            exchange='',
-            routing_key=queue,
-            body=json.dumps(message).encode(),
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # Persistent message
-                correlation_id=message['correlation_id']
-            )
-        )
-
-    def consume_queue(self, queue: str, functions: dict):
-        while True:
-            try:
-                conn = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
-            except pika.exceptions.AMQPConnectionError:
-                print(f"Retrying connection for queue {queue}...")
-                time.sleep(5)
-            except Exception as e:
-                print(f"Failed to connect to RabbitMQ: {str(e)}")
-                time.sleep(5)
-            else:
-                print(f"RabbitMQ Connected")
-                break
-        channel = conn.channel()
-        channel.queue_declare(queue=queue, durable=True)
-        while True:
-            try:
-                for method, properties, body in channel.consume(queue=queue, inactivity_timeout=30):
-                    if body:
-                        res = json.loads(body.decode())
-                        response = self.process(res, functions)
-
-                        # Prepare the status message
-                        status_message = {
-                            'status': 'Processed',
-                            'correlation_id': properties.correlation_id
-                        }
-
-                        # We signal that the message is received and processed, rabbitMQ will now remove it from the
-                        # queue or retry
-                        if response == RequestStatusEnum.SUCCESS:
-                            channel.basic_ack(delivery_tag=method.delivery_tag)
-                        elif response == RequestStatusEnum.FAIL:
-                            status_message['status'] = 'Failed'
-                            channel.basic_ack(delivery_tag=method.delivery_tag)
-                        else:
-                            # Try again later
-                            status_message['status'] = 'Retrying'
-                            channel.basic_nack(delivery_tag=method.delivery_tag)
-                        # Send the status message to the status queue
-                        self.send_status(properties.reply_to, status_message, channel)
-            except (pika.exceptions.StreamLostError, pika.exceptions.ConnectionClosedByBroker):
-                print("Connection to RabbitMQ Lost. Retrying connection...")
-                try:
-                    conn.close()
-                except pika.exceptions.ConnectionWrongStateError:
-                    pass
-                while True:
-                    try:
-                        conn = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
-                    except pika.exceptions.AMQPConnectionError:
-                        print(f"Retrying connection for queue {queue}...")
-                        time.sleep(5)
-                    except Exception as e:
-                        print(f"Failed to connect to RabbitMQ: {str(e)}")
-                        time.sleep(5)
-                    else:
-                        print(f"RabbitMQ Connected")
-                        break
-                    time.sleep(3)
-                channel = conn.channel()
-                channel.queue_declare(queue=queue, durable=True)
-                continue
-
-class RequestStatusEnum(Enum):
-    SUCCESS = 1
-    RETRY = 2
+import asyncio
+import pika
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from enum import Enum
+from typing import Callable
+
+import aio_pika
+import redis
+
+from common.messages import TaskMessage, StatusMessage, encode, decode, DecodeError
+from common.hashring import BARRIER_PREFIX
+from common.metrics import Counter, Histogram
+
+# Correlation id of the message that is being processed, the saga steps derive their idempotency keys from it
+current_correlation_id: ContextVar[str | None] = ContextVar('current_correlation_id', default=None)
+
+MESSAGE_DURATION = Histogram("consumer_message_duration_seconds", "Time spent processing a message, per function",
+                             ("function",))
+MESSAGES_PROCESSED = Counter("consumer_messages_total", "Processed messages, per function and resulting status",
+                             ("function", "status"))
+
+# Marks a user's sequence number as done, unless a later one is done already (a redelivered message finishing late)
+MARK_DONE_LUA = """
+if tonumber(redis.call('GET', KEYS[1]) or 0) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+"""
+
+
+class SequenceGate:
+    """Lets the messages of a user through one at a time, in the order of the sequence numbers the order service
+    gave them, no matter which consumer received them.
+
+    A message waits until the message before it is done. If it is still waiting after `wait_timeout` seconds it is
+    given back to RabbitMQ, so a consumer never blocks on a predecessor that sits behind it in its own prefetch
+    buffer. A predecessor that has not been done `gap_timeout` seconds after its successor first arrived is presumed
+    lost (e.g. its publish failed) and skipped.
+    """
+
+    DONE_PREFIX = "user_done:"
+    WAITING_PREFIX = "user_waiting:"
+
+    def __init__(self, db: redis.Redis, wait_timeout: float, gap_timeout: float):
+        self.db = db
+        self.wait_timeout = wait_timeout
+        self.gap_timeout = gap_timeout
+        self.mark_done_script = db.register_script(MARK_DONE_LUA)
+
+    def wait(self, user_id: str, seq: int) -> bool:
+        deadline = time.monotonic() + self.wait_timeout
+        waiting_key = f"{self.WAITING_PREFIX}{user_id}:{seq}"
+        delay = 0.005
+        while True:
+            done = int(self.db.get(f"{self.DONE_PREFIX}{user_id}") or 0)
+            if done >= seq - 1:
+                return True
+            self.db.set(waiting_key, time.time(), nx=True, ex=max(1, int(self.gap_timeout * 2)))
+            if time.time() - float(self.db.get(waiting_key) or time.time()) > self.gap_timeout:
+                print(f"Skipping the lost messages {done + 1}..{seq - 1} of user {user_id}")
+                return True
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def done(self, user_id: str, seq: int):
+        self.mark_done_script(keys=[f"{self.DONE_PREFIX}{user_id}"], args=[seq])
+
+
+class RabbitMQConsumer:
+    def __init__(self, prefetch_count: int = 0, ack_batch_size: int = 1, sequence_gate: SequenceGate | None = None,
+                 barrier_gate: Callable[[str], None] | None = None):
+        # A prefetch count of 0 lets RabbitMQ push an unbounded number of unacknowledged messages
+        self.prefetch_count = prefetch_count
+        # Acks are sent with multiple=True once per batch, which can never be larger than the prefetch window
+        self.ack_batch_size = min(ack_batch_size, prefetch_count) if prefetch_count else ack_batch_size
+        # queue -> number of delivered messages that are being processed or waiting for their ack
+        self.unacked: dict[str, int] = {}
+        self.sequence_gate = sequence_gate
+        # Called with the `after` barrier of a message, returns once the barrier has been processed
+        self.barrier_gate = barrier_gate
+
+    @staticmethod
+    def decode_task(body: bytes, content_type: str | None) -> TaskMessage | None:
+        try:
+            return decode(body, TaskMessage, content_type)
+        except DecodeError:
+            print(f"Invalid message: {body}")
+            return None
+
+    @staticmethod
+    def process(message: TaskMessage | None, functions: dict, correlation_id: str | None = None,
+                sequence_gate: SequenceGate | None = None, barrier_gate: Callable[[str], None] | None = None):
+        functions.update(globals())
+        if message is None or message.function not in functions:
+            # Invalid request, do not retry
+            return RequestStatusEnum.FAIL
+        if barrier_gate is not None and message.after:
+            # The user was moved to this queue, its earlier messages may still wait in front of the barrier
+            barrier_gate(message.after)
+        gated = sequence_gate is not None and message.seq is not None
+        if gated and not sequence_gate.wait(message.user_id, message.seq):
+            # An earlier message of the user is still being processed, possibly by another consumer
+            return RequestStatusEnum.RETRY
+        token = current_correlation_id.set(correlation_id)
+        try:
+            with MESSAGE_DURATION.labels(message.function).time():
+                response = functions[message.function](*message.args)
+        finally:
+            current_correlation_id.reset(token)
+        MESSAGES_PROCESSED.labels(message.function, status_of(response)).inc()
+        if gated and response != RequestStatusEnum.RETRY:
+            sequence_gate.done(message.user_id, message.seq)
+        return response
+
+    def consume_queue(self, queue: str, functions: dict, priority: int | None = None):
+        """Consume a queue. RabbitMQ only hands messages to a consumer with a lower priority while the consumers
+        with a higher priority have no room left in their prefetch window."""
+        arguments = {'x-priority': priority} if priority is not None else None
+        while True:
+            try:
+                conn = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+            except pika.exceptions.AMQPConnectionError:
+                print(f"Retrying connection for queue {queue}...")
+                time.sleep(5)
+            except Exception as e:
+                print(f"Failed to connect to RabbitMQ: {str(e)}")
+                time.sleep(5)
+            else:
+                print(f"RabbitMQ Connected")
+                break
+        channel = self.open_channel(conn, queue)
+        status_publisher = StatusPublisher(channel)
+        while True:
+            try:
+                last_tag, pending_acks = None, 0
+                for method, properties, body in channel.consume(queue=queue, inactivity_timeout=1,
+                                                                arguments=arguments):
+                    if not body:
+                        # Nothing arrived for a second, do not hold back the acks of a partial batch
+                        if pending_acks:
+                            channel.basic_ack(delivery_tag=last_tag, multiple=True)
+                            last_tag, pending_acks = None, 0
+                            self.unacked[queue] = 0
+                        continue
+
+                    self.unacked[queue] = pending_acks + 1
+                    response = self.process(self.decode_task(body, properties.content_type), functions,
+                                            properties.correlation_id, self.sequence_gate, self.barrier_gate)
+
+                    # We signal that the message is received and processed, rabbitMQ will now remove it from the
+                    # queue or retry
+                    if response == RequestStatusEnum.RETRY:
+                        # Try again later
+                        channel.basic_nack(delivery_tag=method.delivery_tag)
+                    else:
+                        last_tag, pending_acks = method.delivery_tag, pending_acks + 1
+                        if pending_acks >= self.ack_batch_size:
+                            channel.basic_ack(delivery_tag=last_tag, multiple=True)
+                            last_tag, pending_acks = None, 0
+                    self.unacked[queue] = pending_acks
+
+                    # Send the status message to the status queue, in the format the request came in
+                    status_message = StatusMessage(correlation_id=properties.correlation_id,
+                                                   status=status_of(response))
+                    status_publisher.publish(properties.reply_to, status_message, properties.content_type)
+            except (pika.exceptions.StreamLostError, pika.exceptions.ConnectionClosedByBroker):
+                print("Connection to RabbitMQ Lost. Retrying connection...")
+                try:
+                    conn.close()
+                except pika.exceptions.ConnectionWrongStateError:
+                    pass
+                while True:
+                    try:
+                        conn = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+                    except pika.exceptions.AMQPConnectionError:
+                        print(f"Retrying connection for queue {queue}...")
+                        time.sleep(5)
+                    except Exception as e:
+                        print(f"Failed to connect to RabbitMQ: {str(e)}")
+                        time.sleep(5)
+                    else:
+                        print(f"RabbitMQ Connected")
+                        break
+                    time.sleep(3)
+                channel = self.open_channel(conn, queue)
+                status_publisher = StatusPublisher(channel)
+                continue
+
+    def open_channel(self, conn: pika.BlockingConnection, queue: str):
+        channel = conn.channel()
+        if self.prefetch_count:
+            channel.basic_qos(prefetch_count=self.prefetch_count)
+        channel.queue_declare(queue=queue, durable=True)
+        self.unacked[queue] = 0
+        return channel
+
+
+class StatusPublisher:
+    """Publishes status messages on a channel, declaring every reply queue only once."""
+
+    def __init__(self, channel: pika.adapters.blocking_connection.BlockingChannel):
+        self.channel = channel
+        self.declared_queues = set()
+
+    def publish(self, queue: str, message: StatusMessage, content_type: str | None):
+        if queue not in self.declared_queues:
+            self.channel.queue_declare(queue=queue, durable=True)
+            self.declared_queues.add(queue)
+
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=queue,
+            body=encode(message, content_type),
+            properties=pika.BasicProperties(
+                content_type=content_type,
+                delivery_mode=2,  # Persistent message
+                correlation_id=message.correlation_id
+            )
+        )
+
+
+class AsyncStatusPublisher:
+    """Publishes status messages in batches on a channel with publisher confirms.
+
+    A batch is sent once it holds `batch_size` messages or `flush_interval` seconds after its first message. All
+    messages of a batch are published before their confirms are awaited together, and `publish` returns once the
+    broker confirmed the message.
+    """
+
+    def __init__(self, channel: aio_pika.abc.AbstractChannel, batch_size: int, flush_interval: float):
+        self.channel = channel
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.declared_queues = set()
+        self.batch: list[tuple[str, StatusMessage, str | None, asyncio.Future]] = []
+        self.flush_task: asyncio.Task | None = None
+
+    async def publish(self, queue: str, message: StatusMessage, content_type: str | None):
+        confirmed = asyncio.get_running_loop().create_future()
+        self.batch.append((queue, message, content_type, confirmed))
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+        await confirmed
+
+    async def flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        try:
+            for queue in {queue for queue, _, _, _ in batch} - self.declared_queues:
+                await self.channel.declare_queue(queue, durable=True)
+                self.declared_queues.add(queue)
+
+            results = await asyncio.gather(*(
+                self.channel.default_exchange.publish(
+                    aio_pika.Message(
+                        body=encode(message, content_type),
+                        content_type=content_type,
+                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                        correlation_id=message.correlation_id),
+                    routing_key=queue)
+                for queue, message, content_type, _ in batch), return_exceptions=True)
+        except Exception as e:
+            # Every publisher waits for its confirm, so the failure is handed to all of them instead of raised here
+            for _, _, _, confirmed in batch:
+                if not confirmed.done():
+                    confirmed.set_exception(e)
+            return
+        for (_, _, _, confirmed), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                confirmed.set_exception(result)
+            else:
+                confirmed.set_result(None)
+
+
+DEFAULT_EXECUTOR_WORKERS = 32
+
+
+class AsyncRabbitMQConsumer:
+    """Consumes queues on an asyncio event loop, keeping up to `prefetch_count` messages per queue in flight.
+
+    Messages of the same user are processed one after another in the order they were delivered, messages of
+    different users run concurrently. The saga functions themselves are blocking, they run on a thread pool so they
+    share the pooled HTTP sessions with the blocking consumer.
+    """
+
+    def __init__(self, prefetch_count: int, status_batch_size: int = 64, status_flush_interval: float = 0.01,
+                 sequence_gate: SequenceGate | None = None, barrier_gate: Callable[[str], None] | None = None,
+                 executor_workers: int = 0):
+        self.prefetch_count = prefetch_count
+        self.sequence_gate = sequence_gate
+        self.barrier_gate = barrier_gate
+        self.status_batch_size = status_batch_size
+        self.status_flush_interval = status_flush_interval
+        # Every message in flight needs a thread for its saga, so the pool defaults to the prefetch window. A prefetch
+        # count of 0 is unlimited in AMQP, then the pool needs a size of its own or gets DEFAULT_EXECUTOR_WORKERS
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers or prefetch_count or DEFAULT_EXECUTOR_WORKERS)
+        # user_id -> [lock, number of messages holding or waiting for the lock]
+        self.user_locks: dict[str, list] = {}
+        # queue -> number of delivered messages that are being processed or waiting for their ack
+        self.unacked: dict[str, int] = {}
+
+    async def consume_queue(self, queue: str, functions: dict, priority: int | None = None):
+        arguments = {'x-priority': priority} if priority is not None else None
+        while True:
+            try:
+                # A robust connection reconnects and restores the consumer by itself once it has been established
+                connection = await aio_pika.connect_robust(host='rabbitmq')
+            except Exception as e:
+                print(f"Failed to connect to RabbitMQ: {str(e)}")
+                await asyncio.sleep(5)
+            else:
+                print(f"RabbitMQ Connected")
+                break
+        async with connection:
+            channel = await connection.channel()
+            await channel.set_qos(prefetch_count=self.prefetch_count)
+            status_publisher = AsyncStatusPublisher(await connection.channel(publisher_confirms=True),
+                                                    self.status_batch_size, self.status_flush_interval)
+            in_flight = set()
+
+            def finished(task: asyncio.Task):
+                in_flight.discard(task)
+                self.unacked[queue] = len(in_flight)
+
+            async with (await channel.declare_queue(queue, durable=True)).iterator(arguments=arguments) as messages:
+                async for message in messages:
+                    # A handoff barrier may only be processed after every message that was delivered before it
+                    earlier = set(in_flight) if (message.correlation_id or "").startswith(BARRIER_PREFIX) else set()
+                    task = asyncio.create_task(self.handle(message, functions, status_publisher, earlier))
+                    in_flight.add(task)
+                    task.add_done_callback(finished)
+                    self.unacked[queue] = len(in_flight)
+
+    async def handle(self, message: aio_pika.abc.AbstractIncomingMessage, functions: dict,
+                     status_publisher: AsyncStatusPublisher, earlier: set[asyncio.Task] = frozenset()):
+        if earlier:
+            await asyncio.wait(earlier)
+        task = RabbitMQConsumer.decode_task(message.body, message.content_type)
+        key = task.user_id if task and task.user_id else message.correlation_id
+        entry = self.user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                response = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, RabbitMQConsumer.process, task, functions, message.correlation_id,
+                    self.sequence_gate, self.barrier_gate)
+        except Exception as e:
+            print(f"Failed to process message: {str(e)}")
+            response = RequestStatusEnum.RETRY
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.user_locks[key]
+
+        # The message is only acknowledged once its status is confirmed, so a status is never lost
+        try:
+            await status_publisher.publish(message.reply_to,
+                                           StatusMessage(correlation_id=message.correlation_id,
+                                                         status=status_of(response)),
+                                           message.content_type)
+        except Exception as e:
+            # Requeued, the redelivery skips the saga steps that completed through their idempotency keys
+            print(f"Failed to send status: {str(e)}")
+            await message.nack(requeue=True)
+            return
+
+        if response == RequestStatusEnum.RETRY:
+            await message.nack()
+        else:
+            await message.ack()
+
+
+def status_of(response) -> str:
+    if response == RequestStatusEnum.SUCCESS:
+        return 'Processed'
+    if response == RequestStatusEnum.FAIL:
+        return 'Failed'
+    return 'Retrying'
+
+
+class RequestStatusEnum(Enum):
+    SUCCESS = 1
+    RETRY = 2
     FAIL = 3
\ No newline at end of file
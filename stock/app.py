@@ -1,21 +1,38 @@
 import logging
 import os
 import atexit
+import threading
+import time
 import uuid
 
 import redis
-import redis_lock
 from msgspec import msgpack, Struct
-from flask import Flask, jsonify, abort, Response
+from flask import Flask, jsonify, abort, Response, request
+
+from common.metrics import instrument_app, instrument_redis
+from common.reservations import (COMMIT_RESERVATION_LUA, EXISTING_RESERVATION_LUA, RESERVATION_COMMITTED,
+                                 RESERVATION_CONFLICT, RESERVATION_HELD, RESERVATION_NOT_FOUND, RESERVATION_TTL,
+                                 RESERVATIONS_KEY, release_expired_reservations, release_expired_reservations_lua,
+                                 release_reservation_lua, reservation_key)
+from common.service import (BATCH_INIT_PROGRESS_KEY, IDEMPOTENCY_KEY_REUSED, IDEMPOTENCY_KEY_REUSED_STR,
+                            IDEMPOTENCY_TTL, IDEMPOTENT_LUA, batch_init_chunked, batch_response,
+                            check_redis_maxclients, connect_redis, get_ids_from_request, idempotency_record_key)
 
 DB_ERROR_STR = "DB error"
 
+# The consumers cache prices. Items whose price changed are published on this channel, ALL_ITEMS when every item may
+# have changed, so the consumers drop them from their cache
+PRICE_CHANGES_CHANNEL = "price_changes"
+ALL_ITEMS = "*"
+
 app = Flask("stock-service")
 
-db: redis.Redis = redis.StrictRedis(host=os.environ['REDIS_HOST'],
-                                    port=int(os.environ['REDIS_PORT']),
-                                    password=os.environ['REDIS_PASSWORD'],
-                                    db=int(os.environ['REDIS_DB']))
+db: redis.Redis = connect_redis()
+
+# Every gunicorn worker keeps its own metrics. With METRICS_DIR set, /metrics answers with the sum of all workers
+METRICS_DIR = os.environ.get('METRICS_DIR')
+instrument_app(app, directory=METRICS_DIR)
+instrument_redis(db)
 
 
 def close_db_connection():
@@ -30,6 +47,103 @@ class StockValue(Struct):
     price: int
 
 
+# Atomically read-modify-write the msgpack encoded StockValue of a single item. Runs server-side in one round trip,
+# so updates to different items never block each other and no global lock is needed.
+# KEYS = idempotency record, item. ARGV = idempotency TTL, amount.
+# Returns {status, stock}: status 0 = updated, 1 = item not found, 2 = insufficient stock.
+UPDATE_STOCK_LUA = """
+local function update()
+    local entry = redis.call('GET', KEYS[2])
+    if not entry then
+        return {1, 0}
+    end
+    local item = cmsgpack.unpack(entry)
+    local stock = item['stock'] + tonumber(ARGV[2])
+    if stock < 0 then
+        return {2, item['stock']}
+    end
+    item['stock'] = stock
+    redis.call('SET', KEYS[2], cmsgpack.pack(item))
+    return {0, stock}
+end
+""" + IDEMPOTENT_LUA
+
+# Same as UPDATE_STOCK_LUA, but for every item in KEYS[2..] with the amounts in ARGV[2..]. All items are checked
+# before any of them is written, so either every item is updated or none are.
+# Returns {status, index}: index is the 1-based position of the item that made the update fail.
+UPDATE_STOCK_BATCH_LUA = """
+local function update()
+    local items = {}
+    for i = 2, #KEYS do
+        local entry = redis.call('GET', KEYS[i])
+        if not entry then
+            return {1, i - 1}
+        end
+        local item = cmsgpack.unpack(entry)
+        item['stock'] = item['stock'] + tonumber(ARGV[i])
+        if item['stock'] < 0 then
+            return {2, i - 1}
+        end
+        items[i] = item
+    end
+    for i = 2, #KEYS do
+        redis.call('SET', KEYS[i], cmsgpack.pack(items[i]))
+    end
+    return {0, 0}
+end
+""" + IDEMPOTENT_LUA
+
+# Same checks as UPDATE_STOCK_BATCH_LUA, but the subtracted quantities are also recorded in a reservation hash
+# (KEYS[1], item id -> quantity) and the reservation id is added to the expiry set (KEYS[2]) until it is committed,
+# released or expired. Reserving an id that is already reserved or committed with the same quantities does nothing,
+# so a retried reserve is harmless; with other quantities it is a conflict.
+# ARGV = expires_at, reservation id, quantities of KEYS[3..].
+RESERVE_STOCK_LUA = """
+local EMPTY_RESERVATION_FIELD = ''
+local held = {}
+for i = 3, #KEYS do
+    table.insert(held, KEYS[i])
+    table.insert(held, ARGV[i])
+end
+if #held == 0 then
+    -- An order without items holds nothing, but its reservation must exist so commit and release succeed
+    held = {EMPTY_RESERVATION_FIELD, 0}
+end
+""" + EXISTING_RESERVATION_LUA + """
+local items = {}
+for i = 3, #KEYS do
+    local entry = redis.call('GET', KEYS[i])
+    if not entry then
+        return {1, i - 2}
+    end
+    local item = cmsgpack.unpack(entry)
+    item['stock'] = item['stock'] - tonumber(ARGV[i])
+    if item['stock'] < 0 then
+        return {2, i - 2}
+    end
+    items[i] = item
+end
+for i = 3, #KEYS do
+    redis.call('SET', KEYS[i], cmsgpack.pack(items[i]))
+end
+redis.call('HSET', KEYS[1], unpack(held))
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[2])
+return {0, 0}
+"""
+
+STOCK_UPDATED = 0
+ITEM_NOT_FOUND = 1
+INSUFFICIENT_STOCK = 2
+
+stock_decoder = msgpack.Decoder(StockValue)
+update_stock_script = db.register_script(UPDATE_STOCK_LUA)
+update_stock_batch_script = db.register_script(UPDATE_STOCK_BATCH_LUA)
+reserve_stock_script = db.register_script(RESERVE_STOCK_LUA)
+release_stock_script = db.register_script(release_reservation_lua('stock'))
+release_expired_stock_script = db.register_script(release_expired_reservations_lua('stock'))
+commit_stock_script = db.register_script(COMMIT_RESERVATION_LUA)
+
+
 def get_item_from_db(item_id: str) -> StockValue | None:
     # get serialized data
     try:
@@ -46,15 +160,20 @@ def get_item_from_db(item_id: str) -> StockValue | None:
 
 @app.post('/item/create/<price>')
 def create_item(price: int):
-    with redis_lock.Lock(db, "create_item"):
-        key = str(uuid.uuid4())
-        app.logger.debug(f"Item: {key} created")
-        value = msgpack.encode(StockValue(stock=0, price=int(price)))
-        try:
-            db.set(key, value)
-        except redis.exceptions.RedisError:
-            return abort(400, DB_ERROR_STR)
-        return jsonify({'item_id': key})
+    key = str(uuid.uuid4())
+    app.logger.debug(f"Item: {key} created")
+    value = msgpack.encode(StockValue(stock=0, price=int(price)))
+    try:
+        db.set(key, value)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    return jsonify({'item_id': key})
+
+
+def write_items_chunk(pipe: redis.client.Pipeline, chunk: dict[str, bytes]):
+    pipe.mset(chunk)
+    # the items may have existed before with another price
+    pipe.publish(PRICE_CHANGES_CHANNEL, ALL_ITEMS)
 
 
 @app.post('/batch_init/<n>/<starting_stock>/<item_price>')
@@ -62,13 +181,22 @@ def batch_init_users(n: int, starting_stock: int, item_price: int):
     n = int(n)
     starting_stock = int(starting_stock)
     item_price = int(item_price)
-    kv_pairs: dict[str, bytes] = {f"{i}": msgpack.encode(StockValue(stock=starting_stock, price=item_price))
-                                  for i in range(n)}
+    value = msgpack.encode(StockValue(stock=starting_stock, price=item_price))
+    try:
+        written = batch_init_chunked(db, lambda _: value, n, f"stock/{n}/{starting_stock}/{item_price}",
+                                     request.args.get('resume', 'true') == 'true', app.logger, write_items_chunk)
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    return jsonify({"msg": "Batch init for stock successful", "written": written})
+
+
+@app.get('/batch_init/progress')
+def batch_init_progress():
     try:
-        db.mset(kv_pairs)
+        progress = db.hgetall(BATCH_INIT_PROGRESS_KEY)
     except redis.exceptions.RedisError:
         return abort(400, DB_ERROR_STR)
-    return jsonify({"msg": "Batch init for stock successful"})
+    return jsonify({key.decode(): value.decode() for key, value in progress.items()})
 
 
 @app.get('/find/<item_id>')
@@ -82,33 +210,160 @@ def find_item(item_id: str):
     )
 
 
+def update_stock(item_id: str, amount: int) -> tuple[int, int]:
+    try:
+        status, stock = update_stock_script(keys=[idempotency_record_key(), item_id], args=[IDEMPOTENCY_TTL, amount])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if status == IDEMPOTENCY_KEY_REUSED:
+        abort(422, IDEMPOTENCY_KEY_REUSED_STR)
+    if status == ITEM_NOT_FOUND:
+        # if item does not exist in the database; abort
+        abort(400, f"Item: {item_id} not found!")
+    return status, stock
+
+
+@app.post('/find_batch')
+def find_items():
+    """Find many items with a single MGET. Takes a list of item ids, answers with an item (or null) per id."""
+    item_ids = get_ids_from_request()
+    try:
+        entries: list[bytes | None] = db.mget(item_ids) if item_ids else []
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    items = []
+    for item_id, entry in zip(item_ids, entries):
+        item: StockValue | None = stock_decoder.decode(entry) if entry else None
+        items.append({"item_id": item_id, "stock": item.stock, "price": item.price} if item else None)
+    return batch_response(items)
+
+
+def get_amount(amount: str) -> int:
+    """Read an amount from the url, a negative amount would turn a subtraction into an addition."""
+    try:
+        amount = int(amount)
+    except ValueError:
+        abort(400, f"Amount: {amount} is not a number!")
+    if amount <= 0:
+        abort(400, f"Amount: {amount} must be positive!")
+    return amount
+
+
 @app.post('/add/<item_id>/<amount>')
 def add_stock(item_id: str, amount: int):
-    with redis_lock.Lock(db, "add_stock"):
-        item_entry: StockValue = get_item_from_db(item_id)
-        # update stock, serialize and update database
-        item_entry.stock += int(amount)
-        try:
-            db.set(item_id, msgpack.encode(item_entry))
-        except redis.exceptions.RedisError:
-            return abort(400, DB_ERROR_STR)
-        return Response(f"Item: {item_id} stock updated to: {item_entry.stock}", status=200)
+    _, stock = update_stock(item_id, get_amount(amount))
+    return Response(f"Item: {item_id} stock updated to: {stock}", status=200)
 
 
 @app.post('/subtract/<item_id>/<amount>')
 def remove_stock(item_id: str, amount: int):
-    with redis_lock.Lock(db, "subtract_lock"):
-        item_entry: StockValue = get_item_from_db(item_id)
-        # update stock, serialize and update database
-        item_entry.stock -= int(amount)
-        app.logger.debug(f"Item: {item_id} stock updated to: {item_entry.stock}")
-        if item_entry.stock < 0:
-            abort(400, f"Item: {item_id} stock cannot get reduced below zero!")
-        try:
-            db.set(item_id, msgpack.encode(item_entry))
-        except redis.exceptions.RedisError:
-            return abort(400, DB_ERROR_STR)
-        return Response(f"Item: {item_id} stock updated to: {item_entry.stock}", status=200)
+    status, stock = update_stock(item_id, -get_amount(amount))
+    if status == INSUFFICIENT_STOCK:
+        abort(400, f"Item: {item_id} stock cannot get reduced below zero!")
+    app.logger.debug(f"Item: {item_id} stock updated to: {stock}")
+    return Response(f"Item: {item_id} stock updated to: {stock}", status=200)
+
+
+def get_batch_from_request() -> dict[str, int]:
+    """Read a {item_id: quantity} body, encoded as msgpack or JSON depending on the Content-Type."""
+    try:
+        if request.mimetype == 'application/msgpack':
+            batch = msgpack.decode(request.get_data(), type=dict[str, int])
+        else:
+            batch = request.get_json(force=True)
+        batch = {str(item_id): int(quantity) for item_id, quantity in batch.items()}
+    except Exception:
+        abort(400, "Invalid batch, expected a {item_id: quantity} map")
+    # A negative quantity would turn a subtraction into an addition
+    for item_id, quantity in batch.items():
+        if quantity <= 0:
+            abort(400, f"Item: {item_id} quantity must be positive!")
+    return batch
+
+
+def update_stock_batch(batch: dict[str, int], sign: int):
+    item_ids = list(batch.keys())
+    try:
+        amounts = [sign * quantity for quantity in batch.values()]
+        status, index = update_stock_batch_script(keys=[idempotency_record_key(), *item_ids],
+                                                  args=[IDEMPOTENCY_TTL, *amounts])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if status == IDEMPOTENCY_KEY_REUSED:
+        abort(422, IDEMPOTENCY_KEY_REUSED_STR)
+    if status == ITEM_NOT_FOUND:
+        abort(400, f"Item: {item_ids[index - 1]} not found!")
+    if status == INSUFFICIENT_STOCK:
+        abort(400, f"Item: {item_ids[index - 1]} stock cannot get reduced below zero!")
+
+
+@app.post('/add_batch')
+def add_stock_batch():
+    batch = get_batch_from_request()
+    update_stock_batch(batch, 1)
+    return Response(f"Stock of {len(batch)} items updated", status=200)
+
+
+@app.post('/subtract_batch')
+def remove_stock_batch():
+    batch = get_batch_from_request()
+    update_stock_batch(batch, -1)
+    app.logger.debug(f"Stock of {len(batch)} items subtracted")
+    return Response(f"Stock of {len(batch)} items updated", status=200)
+
+
+@app.post('/reserve/<reservation_id>')
+def reserve_stock(reservation_id: str):
+    """Subtract the stock of a {item_id: quantity} batch and hold it until the reservation is committed or released.
+
+    A reservation that is neither committed nor released within RESERVATION_TTL seconds is released by the reaper.
+    """
+    batch = get_batch_from_request()
+    item_ids = list(batch.keys())
+    try:
+        status, index = reserve_stock_script(keys=[reservation_key(reservation_id), RESERVATIONS_KEY, *item_ids],
+                                             args=[time.time() + RESERVATION_TTL, reservation_id,
+                                                   *batch.values()])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if status == ITEM_NOT_FOUND:
+        abort(400, f"Item: {item_ids[index - 1]} not found!")
+    if status == INSUFFICIENT_STOCK:
+        abort(400, f"Item: {item_ids[index - 1]} stock cannot get reduced below zero!")
+    if status == RESERVATION_CONFLICT:
+        abort(409, f"Reservation: {reservation_id} already holds other quantities!")
+    if status == RESERVATION_HELD:
+        return Response(f"Reservation: {reservation_id} already reserved", status=200)
+    if status == RESERVATION_COMMITTED:
+        return Response(f"Reservation: {reservation_id} already committed", status=200)
+    return Response(f"Stock of {len(batch)} items reserved", status=200)
+
+
+@app.post('/commit/<reservation_id>')
+def commit_stock(reservation_id: str):
+    try:
+        status = commit_stock_script(keys=[reservation_key(reservation_id), RESERVATIONS_KEY],
+                                     args=[reservation_id, IDEMPOTENCY_TTL])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if status == RESERVATION_NOT_FOUND:
+        abort(400, f"Reservation: {reservation_id} not found or expired!")
+    return Response(f"Reservation: {reservation_id} committed", status=200)
+
+
+@app.post('/release/<reservation_id>')
+def release_stock(reservation_id: str):
+    try:
+        status = release_stock_script(keys=[reservation_key(reservation_id), RESERVATIONS_KEY], args=[reservation_id])
+    except redis.exceptions.RedisError:
+        return abort(400, DB_ERROR_STR)
+    if status == RESERVATION_NOT_FOUND:
+        abort(400, f"Reservation: {reservation_id} not found or expired!")
+    return Response(f"Reservation: {reservation_id} released", status=200)
+
+
+threading.Thread(target=release_expired_reservations, args=(release_expired_stock_script, app.logger),
+                 daemon=True).start()
 
 
 if __name__ == '__main__':
@@ -117,3 +372,4 @@ else:
     gunicorn_logger = logging.getLogger('gunicorn.error')
     app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
+    check_redis_maxclients(db, app.logger)
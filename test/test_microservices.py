@@ -1,4 +1,6 @@
+import threading
 import unittest
+import uuid
 
 import utils as tu
 import time
@@ -51,6 +53,21 @@ class TestOrderService(TestMicroservicesBase):
         self.status_attribute = self.add_item_request_status.json()
         self.assertIn(self.status_attribute['status'], ['Failed'])
 
+    def test_statusLongPoll(self):
+        self.add_item_response = tu.add_item_to_order_with_response(self.order_id, "this-is-not-an-item-id", 1)
+        self.assertTrue(tu.status_code_is_success(self.add_item_response.status_code))
+        self.add_item_request_id = self.add_item_response.json()['correlation_id']
+
+        # Long-poll returns the final status without polling again
+        self.add_item_request_status = tu.find_request_status(self.add_item_request_id, wait=5)
+        self.assertTrue(tu.status_code_is_success(self.add_item_request_status.status_code))
+        self.assertIn(self.add_item_request_status.json()['status'], ['Failed'])
+
+    def test_ring(self):
+        ring = tu.find_ring()
+        self.assertGreaterEqual(ring['replicas'], 1)
+        self.assertEqual(ring['pending_barriers'], [])
+
 class TestOrderServiceMore(TestOrderService):
     def setUp(self):
         super().setUp()
@@ -195,6 +212,194 @@ class TestMicroservices(unittest.TestCase):
         stock_after_subtract: int = tu.find_item(item_id)['stock']
         self.assertEqual(stock_after_subtract, 35)
 
+    def test_stock_batch(self):
+        item_id1: str = tu.create_item(5)['item_id']
+        item_id2: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id1, 10)))
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id2, 1)))
+
+        # Test /stock/subtract_batch, one item short means no item is subtracted
+        over_subtract_stock_response = tu.subtract_stock_batch({item_id1: 5, item_id2: 2})
+        self.assertTrue(tu.status_code_is_failure(over_subtract_stock_response))
+        self.assertEqual(tu.find_item(item_id1)['stock'], 10)
+        self.assertEqual(tu.find_item(item_id2)['stock'], 1)
+
+        subtract_stock_response = tu.subtract_stock_batch({item_id1: 5, item_id2: 1})
+        self.assertTrue(tu.status_code_is_success(subtract_stock_response))
+        self.assertEqual(tu.find_item(item_id1)['stock'], 5)
+        self.assertEqual(tu.find_item(item_id2)['stock'], 0)
+
+        # Quantities that are not positive are rejected, they would add stock
+        self.assertTrue(tu.status_code_is_failure(tu.subtract_stock_batch({item_id1: -100})))
+        self.assertTrue(tu.status_code_is_failure(tu.subtract_stock_batch({item_id1: 0})))
+        self.assertEqual(tu.find_item(item_id1)['stock'], 5)
+
+    def test_reservations(self):
+        item_id: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 10)))
+        user_id: str = tu.create_user()['user_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 10)))
+
+        # Reserved stock and credit are taken away until the reservation is released
+        release_id = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_success(tu.reserve_stock(release_id, {item_id: 4})))
+        self.assertTrue(tu.status_code_is_success(tu.reserve_credit(release_id, user_id, 4)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 6)
+        self.assertEqual(tu.find_user(user_id)['credit'], 6)
+        self.assertTrue(tu.status_code_is_success(tu.release_stock(release_id)))
+        self.assertTrue(tu.status_code_is_success(tu.release_credit(release_id)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 10)
+        self.assertEqual(tu.find_user(user_id)['credit'], 10)
+
+        # A committed reservation keeps the stock and credit subtracted and can not be released anymore
+        commit_id = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_failure(tu.reserve_stock(commit_id, {item_id: 11})))
+        self.assertTrue(tu.status_code_is_success(tu.reserve_stock(commit_id, {item_id: 3})))
+        self.assertTrue(tu.status_code_is_success(tu.reserve_credit(commit_id, user_id, 3)))
+        self.assertTrue(tu.status_code_is_success(tu.commit_stock(commit_id)))
+        self.assertTrue(tu.status_code_is_success(tu.commit_credit(commit_id)))
+        self.assertTrue(tu.status_code_is_failure(tu.release_stock(commit_id)))
+        self.assertTrue(tu.status_code_is_failure(tu.release_credit(commit_id)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 7)
+        self.assertEqual(tu.find_user(user_id)['credit'], 7)
+
+        # Reserving a committed id again is a retry with the same quantities and a conflict with others
+        self.assertTrue(tu.status_code_is_success(tu.reserve_stock(commit_id, {item_id: 3})))
+        self.assertTrue(tu.status_code_is_success(tu.reserve_credit(commit_id, user_id, 3)))
+        self.assertTrue(tu.status_code_is_failure(tu.reserve_stock(commit_id, {item_id: 2})))
+        self.assertTrue(tu.status_code_is_failure(tu.reserve_credit(commit_id, user_id, 2)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 7)
+        self.assertEqual(tu.find_user(user_id)['credit'], 7)
+
+        # An order without items holds no stock, but its reservation can be committed like any other
+        empty_id = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_success(tu.reserve_stock(empty_id, {})))
+        self.assertTrue(tu.status_code_is_success(tu.commit_stock(empty_id)))
+
+        # Negative amounts are rejected, they would add stock or credit
+        negative_id = str(uuid.uuid4())
+        self.assertTrue(tu.status_code_is_failure(tu.reserve_stock(negative_id, {item_id: -5})))
+        self.assertTrue(tu.status_code_is_failure(tu.reserve_credit(negative_id, user_id, -5)))
+        self.assertTrue(tu.status_code_is_failure(tu.payment_pay(user_id, -5)))
+        self.assertTrue(tu.status_code_is_failure(tu.subtract_stock(item_id, -5)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 7)
+        self.assertEqual(tu.find_user(user_id)['credit'], 7)
+
+    def test_idempotency_keys(self):
+        item_id: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 10)))
+        user_id: str = tu.create_user()['user_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 10)))
+
+        # A repeated request with the same key is answered like the first one, without writing again
+        idempotency_key = f"test-{item_id}"
+        self.assertTrue(tu.status_code_is_success(tu.subtract_stock(item_id, 3, idempotency_key)))
+        self.assertTrue(tu.status_code_is_success(tu.subtract_stock(item_id, 3, idempotency_key)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 7)
+        self.assertTrue(tu.status_code_is_success(tu.payment_pay(user_id, 3, idempotency_key)))
+        self.assertTrue(tu.status_code_is_success(tu.payment_pay(user_id, 3, idempotency_key)))
+        self.assertEqual(tu.find_user(user_id)['credit'], 7)
+
+        # Requests without a key are all applied
+        self.assertTrue(tu.status_code_is_success(tu.subtract_stock(item_id, 3)))
+        self.assertTrue(tu.status_code_is_success(tu.subtract_stock(item_id, 3)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 1)
+
+        # A key belongs to one endpoint and its arguments: other arguments are refused, another endpoint is applied
+        self.assertEqual(tu.subtract_stock(item_id, 1, idempotency_key), 422)
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 3, idempotency_key)))
+        self.assertEqual(tu.find_item(item_id)['stock'], 4)
+
+    def test_order_item_lines(self):
+        user_id: str = tu.create_user()['user_id']
+        order_id: str = tu.create_order(user_id)['order_id']
+
+        # Quantities of the same item are added up, a repeated request with the same key is not added twice
+        self.assertTrue(tu.status_code_is_success(tu.add_item_process(order_id, "item-a", 2, 3)))
+        self.assertTrue(tu.status_code_is_success(tu.add_item_process(order_id, "item-b", 1, 4, f"test-{order_id}")))
+        self.assertTrue(tu.status_code_is_success(tu.add_item_process(order_id, "item-b", 1, 4, f"test-{order_id}")))
+        self.assertTrue(tu.status_code_is_success(tu.add_item_process(order_id, "item-a", 1, 3)))
+        order: dict = tu.find_order(order_id)
+        self.assertEqual(order['items'], [["item-a", 3], ["item-b", 1]])
+        self.assertEqual(order['total_cost'], 13)
+        self.assertEqual(tu.find_orders([order_id])[0]['total_cost'], 13)
+
+        self.assertTrue(tu.status_code_is_failure(tu.add_item_process("this-is-not-an-order-id", "item-a", 1, 1)))
+
+    def test_metrics(self):
+        item_id: str = tu.create_item(5)['item_id']
+        tu.find_item(item_id)
+
+        # Every service reports its request latency per route in the Prometheus text format
+        for service in ("orders", "stock", "payment"):
+            self.assertIn("# TYPE http_request_duration_seconds histogram", tu.find_metrics(service))
+        self.assertIn("status_queue_lag ", tu.find_metrics("orders"))
+
+        # A sample recorded by another worker only shows up after that worker wrote its next snapshot (every 5s)
+        deadline = time.time() + 10
+        metrics: str = tu.find_metrics("stock")
+        while time.time() < deadline and not ('route="/find/<item_id>"' in metrics
+                                              and "redis_command_duration_seconds_bucket" in metrics):
+            time.sleep(0.5)
+            metrics = tu.find_metrics("stock")
+        self.assertIn('route="/find/<item_id>"', metrics)
+        self.assertIn("redis_command_duration_seconds_bucket", metrics)
+
+    def test_ring_handoff(self):
+        replicas: int = tu.find_ring()['replicas']
+        if replicas < 2:
+            self.skipTest("The ring needs two queues to hand users off")
+        item_id: str = tu.create_item(5)['item_id']
+        self.assertTrue(tu.status_code_is_success(tu.add_stock(item_id, 1000)))
+        orders = {}
+        for _ in range(20):
+            user_id: str = tu.create_user()['user_id']
+            self.assertTrue(tu.status_code_is_success(tu.add_credit_to_user(user_id, 100)))
+            orders[tu.create_order(user_id)['order_id']] = user_id
+
+        # Removing a queue moves its users. Their items are added while the handoff runs, before and after the
+        # barrier was published, and the checkout must not overtake any of them.
+        ring_change = threading.Thread(target=tu.change_ring, args=(replicas - 1,))
+        ring_change.start()
+        for _ in range(5):
+            for order_id in orders:
+                self.assertTrue(tu.status_code_is_success(tu.add_item_to_order(order_id, item_id, 1)))
+            time.sleep(0.5)
+        checkouts = [tu.checkout_order(order_id).json()['correlation_id'] for order_id in orders]
+        ring_change.join()
+        for correlation_id in checkouts:
+            self.assertEqual(tu.find_request_status(correlation_id, wait=20).json()['status'], 'Processed')
+        for order_id, user_id in orders.items():
+            order: dict = tu.find_order(order_id)
+            self.assertTrue(order['paid'])
+            self.assertEqual(order['total_cost'], 25)
+            self.assertEqual(tu.find_user(user_id)['credit'], 75)
+
+        # Give the queue back once the handoff finished
+        self.wait_for_handoff()
+        self.assertTrue(tu.status_code_is_success(tu.change_ring(replicas).status_code))
+        self.wait_for_handoff()
+
+    def wait_for_handoff(self):
+        deadline = time.time() + 30
+        while tu.find_ring()['pending_barriers'] and time.time() < deadline:
+            time.sleep(0.5)
+        self.assertEqual(tu.find_ring()['pending_barriers'], [])
+
+    def test_find_batch(self):
+        item_id: str = tu.create_item(5)['item_id']
+        user_id: str = tu.create_user()['user_id']
+
+        # Test /stock/find_batch, unknown ids are answered with null
+        items: list = tu.find_items([item_id, "this-is-not-an-item-id"])
+        self.assertEqual(items[0], {"item_id": item_id, "stock": 0, "price": 5})
+        self.assertIsNone(items[1])
+
+        # Test /payment/find_users
+        users: list = tu.find_users(["this-is-not-a-user-id", user_id])
+        self.assertIsNone(users[0])
+        self.assertEqual(users[1], {"user_id": user_id, "credit": 0})
+
     def test_payment(self):
         # Test /payment/pay/<user_id>/<order_id>
         user: dict = tu.create_user()
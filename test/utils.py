@@ -16,19 +16,42 @@ def find_item(item_id: str) -> dict:
     return requests.get(f"{STOCK_URL}/stock/find/{item_id}").json()
 
 
-def add_stock(item_id: str, amount: int) -> int:
-    return requests.post(f"{STOCK_URL}/stock/add/{item_id}/{amount}").status_code
+def find_items(item_ids: list[str]) -> list:
+    return requests.post(f"{STOCK_URL}/stock/find_batch", json=item_ids).json()
 
 
-def subtract_stock(item_id: str, amount: int) -> int:
-    return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}").status_code
+def add_stock(item_id: str, amount: int, idempotency_key: str | None = None) -> int:
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key else None
+    return requests.post(f"{STOCK_URL}/stock/add/{item_id}/{amount}", headers=headers).status_code
+
+
+def subtract_stock(item_id: str, amount: int, idempotency_key: str | None = None) -> int:
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key else None
+    return requests.post(f"{STOCK_URL}/stock/subtract/{item_id}/{amount}", headers=headers).status_code
+
+
+def subtract_stock_batch(items_quantities: dict[str, int]) -> int:
+    return requests.post(f"{STOCK_URL}/stock/subtract_batch", json=items_quantities).status_code
+
+
+def reserve_stock(reservation_id: str, items_quantities: dict[str, int]) -> int:
+    return requests.post(f"{STOCK_URL}/stock/reserve/{reservation_id}", json=items_quantities).status_code
+
+
+def commit_stock(reservation_id: str) -> int:
+    return requests.post(f"{STOCK_URL}/stock/commit/{reservation_id}").status_code
+
+
+def release_stock(reservation_id: str) -> int:
+    return requests.post(f"{STOCK_URL}/stock/release/{reservation_id}").status_code
 
 
 ########################################################################################################################
 #   PAYMENT MICROSERVICE FUNCTIONS
 ########################################################################################################################
-def payment_pay(user_id: str, amount: int) -> int:
-    return requests.post(f"{PAYMENT_URL}/payment/pay/{user_id}/{amount}").status_code
+def payment_pay(user_id: str, amount: int, idempotency_key: str | None = None) -> int:
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key else None
+    return requests.post(f"{PAYMENT_URL}/payment/pay/{user_id}/{amount}", headers=headers).status_code
 
 
 def create_user() -> dict:
@@ -39,10 +62,26 @@ def find_user(user_id: str) -> dict:
     return requests.get(f"{PAYMENT_URL}/payment/find_user/{user_id}").json()
 
 
+def find_users(user_ids: list[str]) -> list:
+    return requests.post(f"{PAYMENT_URL}/payment/find_users", json=user_ids).json()
+
+
 def add_credit_to_user(user_id: str, amount: float) -> int:
     return requests.post(f"{PAYMENT_URL}/payment/add_funds/{user_id}/{amount}").status_code
 
 
+def reserve_credit(reservation_id: str, user_id: str, amount: int) -> int:
+    return requests.post(f"{PAYMENT_URL}/payment/reserve/{reservation_id}/{user_id}/{amount}").status_code
+
+
+def commit_credit(reservation_id: str) -> int:
+    return requests.post(f"{PAYMENT_URL}/payment/commit/{reservation_id}").status_code
+
+
+def release_credit(reservation_id: str) -> int:
+    return requests.post(f"{PAYMENT_URL}/payment/release/{reservation_id}").status_code
+
+
 ########################################################################################################################
 #   ORDER MICROSERVICE FUNCTIONS
 ########################################################################################################################
@@ -57,15 +96,38 @@ def add_item_to_order(order_id: str, item_id: str, quantity: int) -> int:
 def add_item_to_order_with_response(order_id: str, item_id: str, quantity: int) -> dict:
     return requests.post(f"{ORDER_URL}/orders/addItem/{order_id}/{item_id}/{quantity}")
 
+def add_item_process(order_id: str, item_id: str, quantity: int, price: int,
+                     idempotency_key: str | None = None) -> int:
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key else None
+    return requests.post(f"{ORDER_URL}/orders/addItemProcess/{order_id}/{item_id}/{quantity}/{price}",
+                         headers=headers).status_code
+
+
 def find_order(order_id: str) -> dict:
     return requests.get(f"{ORDER_URL}/orders/find/{order_id}").json()
 
 
+def find_orders(order_ids: list[str]) -> list:
+    return requests.post(f"{ORDER_URL}/orders/find_batch", json=order_ids).json()
+
+
 def checkout_order(order_id: str) -> requests.Response:
     return requests.post(f"{ORDER_URL}/orders/checkout/{order_id}")
 
-def find_request_status(correlation_id: str) -> dict:
-    return requests.get(f"{ORDER_URL}/orders/status/{correlation_id}")
+def find_ring() -> dict:
+    return requests.get(f"{ORDER_URL}/orders/ring").json()
+
+
+def change_ring(replicas: int) -> requests.Response:
+    return requests.post(f"{ORDER_URL}/orders/ring/{replicas}")
+
+
+def find_request_status(correlation_id: str, wait: float = 0) -> requests.Response:
+    return requests.get(f"{ORDER_URL}/orders/status/{correlation_id}", params={'wait': wait})
+
+
+def find_metrics(service: str) -> str:
+    return requests.get(f"{ORDER_URL}/{service}/metrics").text
 
 
 ########################################################################################################################